@@ -1,29 +1,53 @@
 import uuid
+import asyncio
 import threading 
+import weakref
 import os
 import re
 import json
+import hashlib
+import hmac
+import secrets
+import random
+import select
+import socket
+import ipaddress
 from psycopg2.extras import Json, RealDictCursor
 import base64
 import time
 import logging
 import tempfile
+import zipfile
+import multiprocessing
+from contextlib import contextmanager, aclosing
 from datetime import datetime
+from urllib.parse import urlsplit
 import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import httpx
+import httpcore
 from fastapi import Request
 from typing import Dict, List
 from psycopg2.extras import RealDictCursor
 from fastapi import FastAPI, HTTPException, UploadFile, File, Header, Request
-from fastapi.responses import Response
+from fastapi.responses import Response, JSONResponse, StreamingResponse
+from starlette.datastructures import Headers
 from ibm_watsonx_ai import Credentials, APIClient
 from ibm_watsonx_ai.foundation_models import ModelInference
-from image_processor2 import enhance_image_for_ocr
+from image_processor2 import (
+    decode_image, encode_image, preprocess_image, shrink_to_max_edge, to_grayscale,
+    dhash, hamming_distance, block_means, max_block_difference, estimate_text_lines,
+    is_pdf, read_pdf_text, render_pdf_page,
+    PREPROCESS_PROFILES
+)
 from dotenv import load_dotenv
 
 load_dotenv()
 
 import psycopg2
-from psycopg2.extras import Json
+from psycopg2 import pool as pg_pool
+from psycopg2.extras import Json, execute_values
 DB_CONFIG = {
     "host": os.getenv("DB_HOST"),
     "port": os.getenv("DB_PORT", 5432),
@@ -32,108 +56,349 @@ DB_CONFIG = {
     "password": os.getenv("DB_PASSWORD"),
 }
 
-def get_db_connection():
-    return psycopg2.connect(**DB_CONFIG)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT_SEC = float(os.getenv("DB_POOL_TIMEOUT_SEC", 10))
+
+
+class DBPoolTimeout(Exception):
+    pass
+
+
+class DBConnectionPool:
+    """
+    Shared psycopg2 pool. Checkouts block up to `timeout` seconds for a free
+    connection instead of failing immediately like ThreadedConnectionPool does.
+    """
+
+    def __init__(self, minconn: int, maxconn: int, timeout: float):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.pool = None
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_sec_total = 0.0
+
+    def _get_pool(self):
+        # Created lazily so importing the app never needs a live database
+        if self.pool is None:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = pg_pool.ThreadedConnectionPool(
+                        self.minconn, self.maxconn, **DB_CONFIG
+                    )
+        return self.pool
+
+    def getconn(self):
+        start = time.monotonic()
+        if not self.slots.acquire(timeout=self.timeout):
+            with self.lock:
+                self.timeouts += 1
+            raise DBPoolTimeout(
+                f"No database connection available within {self.timeout}s"
+            )
+        try:
+            conn = self._get_pool().getconn()
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_sec_total += time.monotonic() - start
+        return conn
+
+    def putconn(self, conn):
+        try:
+            # Broken connections are dropped so the next checkout gets a fresh one
+            self._get_pool().putconn(conn, close=bool(conn.closed))
+        finally:
+            with self.lock:
+                self.in_use -= 1
+            self.slots.release()
+
+    def stats(self) -> Dict:
+        with self.lock:
+            idle = len(self.pool._pool) if self.pool is not None else 0
+            return {
+                "max": self.maxconn,
+                "in_use": self.in_use,
+                "idle": idle,
+                "utilisation": round(self.in_use / self.maxconn, 3),
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "avg_wait_ms": round(
+                    1000 * self.wait_sec_total / self.checkouts, 2
+                ) if self.checkouts else 0.0,
+            }
+
+
+db_pool = DBConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT_SEC)
+
+
+@contextmanager
+def db_connection():
+    """Borrow a pooled connection; commits on success, rolls back on error."""
+    conn = db_pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn)
 
 
 def insert_log(job_id, client_ip, api_client, filename, items_extracted, status, duration):
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    cur.execute("""
-        INSERT INTO logs (
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO logs (
+                job_id, client_ip, api_client, filename,
+                items_extracted, status, duration_sec
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """, (
             job_id, client_ip, api_client, filename,
-            items_extracted, status, duration_sec
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s)
-    """, (
-        job_id, client_ip, api_client, filename,
-        items_extracted, status, duration
-    ))
-
-    conn.commit()
-    cur.close()
-    conn.close()
-
+            items_extracted, status, duration
+        ))
+        cur.close()
 
-def insert_document_data(job_id, filename, extracted_data, api_key):
-    conn = get_db_connection()
-    cur = conn.cursor()
 
-    cur.execute("""
-        INSERT INTO document_data (
-            job_id, filename, extracted_data, api_key, status
-        ) VALUES (%s, %s, %s, %s, 'Processing')
-    """, (
-        job_id,
-        filename,
-        Json(extracted_data),
-        api_key
-    ))
+def register_job_documents(job_id, filenames, api_key, queue_items: List[Dict] = None,
+                           callback_url: str = None):
+    """
+    Insert every document_data row for a job in one statement and one
+    transaction, together with its job queue entries when the Postgres queue
+    is in use and its webhook delivery when a callback URL applies.
+    """
+    rows = [(job_id, filename, Json({}), api_key, "Processing") for filename in filenames]
+    with db_connection() as conn:
+        cur = conn.cursor()
+        execute_values(cur, """
+            INSERT INTO document_data (
+                job_id, filename, extracted_data, api_key, status
+            ) VALUES %s
+        """, rows, page_size=max(len(rows), 1))
+        if queue_items:
+            enqueue_invoices(cur, job_id, api_key, queue_items)
+        if WEBHOOKS_ENABLED:
+            register_job_webhook(cur, job_id, api_key, callback_url)
+        cur.close()
 
-    conn.commit()
-    cur.close()
-    conn.close()
 
+# NOTIFY channel carrying per-file status changes to /job-events listeners
+JOB_STATUS_CHANNEL = "job_status"
 
-def update_document_status(job_id, filename, status):
-    conn = get_db_connection()
-    cur = conn.cursor()
 
-    cur.execute("""
-        UPDATE document_data
-        SET status = %s
-        WHERE job_id = %s AND filename = %s
-    """, (status, job_id, filename))
+def notify_status(cur, job_id, filename, status, partial=False):
+    """Queue a status NOTIFY on the caller's transaction; delivered only if it commits."""
+    cur.execute("SELECT pg_notify(%s, %s)", (JOB_STATUS_CHANNEL, json.dumps({
+        "job_id": job_id, "filename": filename, "status": status, "partial": partial
+    })))
 
-    conn.commit()
-    cur.close()
-    conn.close()
 
+def update_document_status(job_id, filename, status):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE document_data
+            SET status = %s, version = version + 1
+            WHERE job_id = %s AND filename = %s
+        """, (status, job_id, filename))
+        notify_status(cur, job_id, filename, status)
+        cur.close()
 
-def background_invoice_processing(job_id: str, filename: str, tmp_path: str, x_api_key: str):
-    try:
-        enhance_image_for_ocr(tmp_path)
-        extracted_data = extract_invoice_from_path(tmp_path)
-        items_count = len(extracted_data.get("items", []))
 
-        # Update DB with extracted data and status Success
-        conn = get_db_connection()
+def complete_document(job_id, filename, extracted_data, x_api_key, client_ip="background"):
+    """Store the extraction, flip the row to Success and log it."""
+    with db_connection() as conn:
         cur = conn.cursor()
         cur.execute("""
             UPDATE document_data
-            SET extracted_data = %s, status = 'Success'
+            SET extracted_data = %s, status = 'Success', version = version + 1
             WHERE job_id = %s AND filename = %s
         """, (Json(extracted_data), job_id, filename))
-        conn.commit()
+        notify_status(cur, job_id, filename, "Success")
         cur.close()
-        conn.close()
-
-        # Log success
-        insert_log(
-            job_id=job_id,
-            client_ip="background",
-            api_client=VALID_API_KEYS[x_api_key],
-            filename=filename,
-            items_extracted=items_count,
-            status="SUCCESS",
-            duration=0
+
+    maybe_queue_webhook(job_id)
+    insert_log(
+        job_id=job_id,
+        client_ip=client_ip,
+        api_client=VALID_API_KEYS[x_api_key],
+        filename=filename,
+        items_extracted=len(extracted_data.get("items", [])),
+        status="SUCCESS",
+        duration=0
+    )
+
+
+def update_partial_document(job_id, filename, partial_data):
+    """Expose header fields to /check-job pollers while the row is still Processing."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE document_data
+            SET extracted_data = %s, version = version + 1
+            WHERE job_id = %s AND filename = %s AND status = 'Processing'
+        """, (Json({**partial_data, "isPartial": True}), job_id, filename))
+        if cur.rowcount:
+            notify_status(cur, job_id, filename, "Processing", partial=True)
+        cur.close()
+
+
+def fail_document(job_id, filename, x_api_key, calls: List[Dict] = None):
+    persist_inference_usage(job_id, filename, calls or [])
+    update_document_status(job_id, filename, "Fail")
+    maybe_queue_webhook(job_id)
+    insert_log(
+        job_id=job_id,
+        client_ip="background",
+        api_client=VALID_API_KEYS[x_api_key],
+        filename=filename,
+        items_extracted=0,
+        status="FAILED",
+        duration=0
+    )
+
+
+def prepare_invoice(spool_path: str, options: Dict, x_api_key: str = None) -> Dict:
+    """
+    CPU stage: read the spooled upload, hash it for near-duplicates and build
+    the model payload. Runs on the worker pool's thread executor.
+    """
+    # Only images currently being worked on are held in memory
+    with open(spool_path, "rb") as f:
+        content = f.read()
+
+    # 📄 PDFs are rendered page by page later, in the PDF process pool
+    if is_pdf(content):
+        return {"pdf": True, "phash": None, "detail": None, "match": None, "earlier": None}
+
+    # 🖼️ Decode once in memory (skipped entirely in "none" mode)
+    preprocess_mode = options["preprocess_mode"]
+    img = decode_image(content) if preprocess_mode != "none" else None
+
+    # 🔍 Near-duplicate check against this client's earlier invoices
+    phash, detail, match = None, None, None
+    if img is not None and NEAR_DUP_POLICY != "off":
+        gray = to_grayscale(img)
+        phash = dhash(gray)
+        if NEAR_DUP_POLICY == "reuse":
+            detail = block_means(gray)
+        match = phash_index.find(phash, x_api_key)
+
+    # A dHash match alone is not proof: invoices on the same dealer template
+    # collide, so only reuse a result when the detailed fingerprint agrees too
+    earlier = None
+    if match and detail is not None and match[0]["cache_key"]:
+        if confirm_near_duplicate(match[0], detail):
+            earlier = extraction_cache.get(match[0]["cache_key"])
+
+    payload, mime, max_new_tokens = None, None, None
+    if earlier is None:
+        payload, mime = prepare_image_payload(content, img, preprocess_mode)
+        max_new_tokens = estimate_output_budget(img)
+
+    return {
+        "pdf": False,
+        "phash": phash,
+        "detail": detail,
+        "match": match,
+        "earlier": earlier,
+        "payload": payload,
+        "mime": mime,
+        "max_new_tokens": max_new_tokens,
+    }
+
+
+def finish_invoice(job_id: str, filename: str, x_api_key: str, cache_key: str,
+                   prepared: Dict, extracted_data: Dict, calls: List[Dict]):
+    """DB stage: cache the result, index the hash and mark the row Success."""
+    earlier, match = prepared["earlier"], prepared["match"]
+    persist_inference_usage(job_id, filename, calls)
+
+    # Remember the result so re-uploads of the same image skip the model
+    if cache_key and extracted_data:
+        extraction_cache.put(cache_key, extracted_data)
+    if prepared["phash"] is not None and extracted_data and earlier is None:
+        remember_phash(prepared["phash"], prepared["detail"], job_id, filename, cache_key, x_api_key)
+
+    if match:
+        ref, distance = match
+        extracted_data = dict(extracted_data)
+        extracted_data["nearDuplicateOf"] = {
+            "jobId": ref["job_id"],
+            "filename": ref["filename"],
+            "distance": distance,
+            "reused": earlier is not None
+        }
+        logger.info(
+            f"{job_id}/{filename} is a near-duplicate of "
+            f"{ref['job_id']}/{ref['filename']} (distance {distance})"
+        )
+
+    # Update DB with extracted data and status Success, then log
+    complete_document(job_id, filename, extracted_data, x_api_key)
+
+
+async def background_invoice_processing(job_id: str, filename: str, spool_path: str, x_api_key: str,
+                                        cache_key: str = None, options: Dict = None,
+                                        final_attempt: bool = True):
+    """
+    One invoice end to end. Blocking stages run on the worker pool's threads;
+    the model call is awaited on the event loop so it holds no thread.
+
+    Returns None on success, else the exception that failed the row. Queue
+    workers pass final_attempt=False on earlier attempts: retryable errors
+    are then re-raised, leaving the row Processing and the spool file in place.
+    """
+    options = options or default_extraction_options()
+    calls = []  # one entry per model call, for token accounting
+    retrying = False
+
+    async def publish_partial(header: Dict):
+        try:
+            await worker_pool.run_blocking(update_partial_document, job_id, filename, header)
+        except Exception as e:
+            logger.warning(f"Partial update failed for {job_id}/{filename}: {e}")
+
+    try:
+        prepared = await worker_pool.run_blocking(prepare_invoice, spool_path, options, x_api_key)
+
+        if prepared["earlier"] is not None:
+            extracted_data = prepared["earlier"]
+        elif prepared["pdf"]:
+            extracted_data = await extract_pdf_invoice(spool_path, options, calls, publish_partial)
+        else:
+            extracted_data = await extract_invoice_async(
+                prepared["payload"], prepared["mime"], options["prompt_version"], calls,
+                prepared["max_new_tokens"], publish_partial
+            )
+
+        await worker_pool.run_blocking(
+            finish_invoice, job_id, filename, x_api_key, cache_key, prepared,
+            extracted_data, calls
         )
 
     except Exception as e:
+        if not final_attempt and is_retryable(e):
+            retrying = True
+            await worker_pool.run_blocking(persist_inference_usage, job_id, filename, calls)
+            raise
         # Mark as failed if any exception
-        update_document_status(job_id, filename, "Fail")
-        insert_log(
-            job_id=job_id,
-            client_ip="background",
-            api_client=VALID_API_KEYS[x_api_key],
-            filename=filename,
-            items_extracted=0,
-            status="FAILED",
-            duration=0
-        )
+        logger.error(f"Extraction failed for {job_id}/{filename}: {e}")
+        await worker_pool.run_blocking(fail_document, job_id, filename, x_api_key, calls)
+        return e
     finally:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+        if not retrying:
+            discard_spool_file(spool_path)
 
 
 ##########################################
@@ -200,11 +465,22 @@ MODEL_ID = os.getenv("IBM_MODEL_ID")
 if not all([API_KEY, SERVICE_URL, PROJECT_ID, MODEL_ID]):
     raise RuntimeError("One or more IBM Watsonx environment variables are missing!")
 
-creds = Credentials(url=SERVICE_URL, api_key=API_KEY)
-api_client = APIClient(creds)
-api_client.set.default_project(PROJECT_ID)
+# "http": async httpx client on the event loop (default)
+# "sdk":  blocking ibm_watsonx_ai ModelInference.chat, run on a thread
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "http").lower()
+IAM_URL = os.getenv("IBM_IAM_URL", "https://iam.cloud.ibm.com/identity/token")
+CHAT_API_VERSION = os.getenv("IBM_CHAT_API_VERSION", "2024-10-08")
+# Upper bound on concurrent model calls; the AIMD controller tunes the live limit below it
+INFERENCE_CONCURRENCY = int(os.getenv("INFERENCE_CONCURRENCY", 32))
+INFERENCE_TIMEOUT_SEC = float(os.getenv("INFERENCE_TIMEOUT_SEC", 300))
 
-model = ModelInference(api_client=api_client, model_id=MODEL_ID)
+model = None
+if INFERENCE_BACKEND == "sdk":
+    creds = Credentials(url=SERVICE_URL, api_key=API_KEY)
+    api_client = APIClient(creds)
+    api_client.set.default_project(PROJECT_ID)
+
+    model = ModelInference(api_client=api_client, model_id=MODEL_ID)
 
 generation_params = {
     "max_new_tokens": 12000,
@@ -625,6 +901,994 @@ Stamp
 Free-text areas
 """
 
+# Same output contract as invoice_prompt in a fraction of the input tokens
+invoice_prompt_compact = """
+Extract data from this invoice image. Return ONLY valid JSON (no markdown, no commentary).
+Use "" for anything not clearly visible. Never guess. Copy values exactly as printed (no reformatting).
+
+Header fields:
+- invoiceNumber: "Invoice No"/"Bill No"/"Inv#" near the top. invoiceNumberType: "Printed" or "Handwritten".
+- invoiceDate: as printed.
+- DealerName: seller business name at the top (no address). DealerPhone: all dealer/seller phone numbers
+  near the dealer name (fallback: stamp/signature area), comma-separated; never customer/bank/transporter numbers.
+- DealerAddress: full address block below the dealer name (fallback: stamp), one string.
+- gstNumber: dealer GSTIN, exactly 15 chars matching [0-9]{2}[A-Z]{5}[0-9]{4}[A-Z][1-9A-Z][A-Z][0-9A-Z], else "".
+- customerName / customerPhone / customerAddress: from the "Bill To"/"Customer"/"Buyer" section.
+- downPayment: "Down Payment"/"DP"/"Advance", often near the hypothecation stamp; handwritten counts; number only.
+- netTotal: final "Grand Total"/"Net Total"/"Amount Payable".
+- EMIAmount: EMI amount if shown.
+- stampPresent: "Present"/"Absent" (company seal, usually bottom-right). informationInStamp: all text in it.
+- signaturePresent: "Yes"/"No". hypothecationStamp: "Present"/"Absent" ("Hypothecated to ...").
+- stampCompanyMatching_score: 0-100 similarity of DealerName and informationInStamp (0 if no stamp).
+
+items: one object per table row, none skipped.
+- Asset Model No: item description/model (no IMEI/serial). brandName: brand (Samsung, Apple, Vivo, TVS, Honda, ...).
+- imeiNumber: 15-digit IMEI. serialNumber: serial/chassis/engine number. quantity: number of units.
+- rate: UNIT price column (left of the tax columns). itemAmount: line total column (usually rightmost);
+  itemAmount >= rate when quantity > 1. Never compute, copy what is printed.
+- sgst/cgst/igst: tax PERCENTAGES only (valid: 0, 0.25, 1, 1.46, 1.5, 3, 5, 6, 9, 12, 14, 18, 28), never amounts.
+  "GST 18%" -> sgst 9, cgst 9, igst "". IGST present -> sgst and cgst "". SGST/CGST present -> igst "".
+
+Any other clearly visible fields (e.g. paymentMode, vehicleNumber, chassisNumber, financeCompany,
+loanAccountNumber, placeOfSupply, dueDate) go in extra camelCase keys; do not repeat values already extracted.
+
+{"invoiceNumber":"","invoiceNumberType":"","invoiceDate":"","DealerName":"","DealerPhone":"","DealerAddress":"",
+"EMIAmount":"","gstNumber":"","customerName":"","customerPhone":"","customerAddress":"","downPayment":"",
+"netTotal":"","stampPresent":"","informationInStamp":"","signaturePresent":"","hypothecationStamp":"",
+"stampCompanyMatching_score":0,"items":[{"itemNo":"","Asset Model No":"","brandName":"","imeiNumber":"",
+"serialNumber":"","quantity":"","rate":"","sgst":"","cgst":"","igst":"","tax":"","itemAmount":""}]}
+"""
+
+##########################################
+# COMPACT WIRE SCHEMA
+##########################################
+# Short header keys and positional item rows; expand_wire_output restores the full shape
+WIRE_HEADER_KEYS = {
+    "invoiceNumber": "inv",
+    "invoiceNumberType": "invT",
+    "invoiceDate": "dt",
+    "DealerName": "dlr",
+    "DealerPhone": "dlrPh",
+    "DealerAddress": "dlrAd",
+    "EMIAmount": "emi",
+    "gstNumber": "gst",
+    "customerName": "cus",
+    "customerPhone": "cusPh",
+    "customerAddress": "cusAd",
+    "downPayment": "dp",
+    "netTotal": "tot",
+    "stampPresent": "stp",
+    "informationInStamp": "stpTx",
+    "signaturePresent": "sig",
+    "hypothecationStamp": "hyp",
+    "stampCompanyMatching_score": "stpSc",
+}
+WIRE_ITEM_FIELDS = [
+    "itemNo", "Asset Model No", "brandName", "imeiNumber", "serialNumber", "quantity",
+    "rate", "sgst", "cgst", "igst", "tax", "itemAmount"
+]
+WIRE_KEY_LOOKUP = {short: key for key, short in WIRE_HEADER_KEYS.items()}
+
+invoice_prompt_wire = invoice_prompt_compact.split('\n{"invoiceNumber"')[0] + f"""
+OUTPUT FORMAT (compact): write each header field under its short key
+({", ".join(f"{key}={short}" for key, short in WIRE_HEADER_KEYS.items())}).
+Write "items" as a list of rows, each row an array in this exact order:
+[{", ".join(WIRE_ITEM_FIELDS)}]. Extra fields keep their own camelCase keys.
+
+{json.dumps({**{short: "" for short in WIRE_HEADER_KEYS.values()}, "stpSc": 0,
+             "items": [[""] * len(WIRE_ITEM_FIELDS)]}, separators=(",", ":"))}
+"""
+
+
+def expand_wire_output(data: Dict) -> Dict:
+    """Compact wire output -> the regular extracted_data shape (unknown keys pass through)."""
+    expanded = {WIRE_KEY_LOOKUP.get(key, key): value for key, value in data.items()}
+    items = []
+    for row in expanded.get("items") or []:
+        if isinstance(row, list):
+            row = row + [""] * (len(WIRE_ITEM_FIELDS) - len(row))
+            items.append(dict(zip(WIRE_ITEM_FIELDS, row)))
+        elif isinstance(row, dict):
+            items.append(row)
+    if "items" in expanded:
+        expanded["items"] = items
+    return expanded
+
+
+PROMPT_VERSIONS = {
+    "full": invoice_prompt,
+    "compact": invoice_prompt_compact,
+    "wire": invoice_prompt_wire,
+}
+# Prompt versions whose output goes through expand_wire_output
+WIRE_PROMPT_VERSIONS = {"wire"}
+DEFAULT_PROMPT_VERSION = os.getenv("PROMPT_VERSION", "full").lower()
+if DEFAULT_PROMPT_VERSION not in PROMPT_VERSIONS:
+    raise RuntimeError(f"PROMPT_VERSION must be one of {list(PROMPT_VERSIONS)}")
+
+# Per-client override, keyed by the client name in VALID_API_KEYS
+CLIENT_PROMPT_VERSIONS = {
+    "Mobile App Client": DEFAULT_PROMPT_VERSION,
+}
+
+##########################################
+# WORKER POOL (BOUNDED, WITH ADMISSION CONTROL)
+##########################################
+# Invoices processed concurrently; with async inference this can be far above the CPU count
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", 64))
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", 500))
+WORKER_CPU_THREADS = int(os.getenv("WORKER_CPU_THREADS", os.cpu_count() or 4))
+WORKER_RETRY_AFTER_SEC = int(os.getenv("WORKER_RETRY_AFTER_SEC", 30))
+
+
+class InvoiceWorkerPool:
+    """
+    Bounded pool of invoice pipelines with admission control. Callers reserve
+    slots for a whole batch up front so a request is either fully admitted or
+    rejected. At most `workers` pipelines run at once; blocking stages (image
+    work, DB writes) go to a thread executor sized for the CPU, while model
+    calls are awaited on the event loop and hold no thread.
+    """
+
+    def __init__(self, workers: int, max_queue: int, cpu_threads: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(
+            max_workers=cpu_threads,
+            thread_name_prefix="invoice-worker"
+        )
+        self.lock = threading.Lock()
+        self.slots = weakref.WeakKeyDictionary()  # event loop -> asyncio.Semaphore
+        self.tasks = set()
+        self.reserved = 0
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.workers + self.max_queue
+
+    def try_reserve(self, count: int) -> bool:
+        with self.lock:
+            if self.reserved + self.queued + self.in_flight + count > self.capacity:
+                self.rejected += count
+                return False
+            self.reserved += count
+            return True
+
+    async def reserve(self, poll_sec: float = 0.5):
+        """Waits for one slot instead of rejecting; for feeds that trickle work in."""
+        while True:
+            with self.lock:
+                if self.reserved + self.queued + self.in_flight < self.capacity:
+                    self.reserved += 1
+                    return
+            await asyncio.sleep(poll_sec)
+
+    def release(self, count: int):
+        with self.lock:
+            self.reserved -= count
+
+    def submit(self, coro_fn, *args) -> asyncio.Task:
+        # Turns one reserved slot into a queued task; must be called on the event loop
+        with self.lock:
+            self.reserved -= 1
+            self.queued += 1
+        task = asyncio.get_running_loop().create_task(self._run(coro_fn, *args))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _run(self, coro_fn, *args):
+        async with loop_local(self.slots, lambda: asyncio.Semaphore(self.workers)):
+            with self.lock:
+                self.queued -= 1
+                self.in_flight += 1
+            try:
+                await coro_fn(*args)
+                with self.lock:
+                    self.completed += 1
+            except Exception:
+                logger.exception("Worker task crashed")
+                with self.lock:
+                    self.failed += 1
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+
+    def idle_workers(self) -> int:
+        with self.lock:
+            return max(0, self.workers - self.reserved - self.queued - self.in_flight)
+
+    async def run_blocking(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "queued": self.queued + self.reserved,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
+
+
+worker_pool = InvoiceWorkerPool(WORKER_POOL_SIZE, WORKER_QUEUE_SIZE, WORKER_CPU_THREADS)
+
+##########################################
+# PDF RENDERING (PROCESS POOL)
+##########################################
+PDF_RENDER_DPI = int(os.getenv("PDF_RENDER_DPI", 200))
+PDF_RENDER_PROCESSES = int(os.getenv("PDF_RENDER_PROCESSES", max(1, (os.cpu_count() or 2) // 2)))
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", 20))
+# "expose": text layer returned with the result, every page still rasterised
+# "prefer": pages with a usable text layer go to the model as text, unrendered
+# "off":    text layer ignored
+PDF_TEXT_LAYER = os.getenv("PDF_TEXT_LAYER", "expose").lower()
+PDF_TEXT_MIN_CHARS = int(os.getenv("PDF_TEXT_MIN_CHARS", 200))
+
+
+class PdfRenderer:
+    """
+    Process pool for PDF work. Rasterising a page holds the GIL for most of
+    its runtime, so pages render in parallel only in separate processes.
+    The pool is spawned lazily; spawn (not fork) keeps the children clear of
+    the server's threads and open connections.
+    """
+
+    def __init__(self, processes: int):
+        self.processes = processes
+        self.executor = None
+        self.lock = threading.Lock()
+        self.documents = 0
+        self.pages_rendered = 0
+        self.render_sec_total = 0.0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ProcessPoolExecutor(
+                        max_workers=self.processes,
+                        mp_context=multiprocessing.get_context("spawn")
+                    )
+        return self.executor
+
+    async def read_text(self, pdf_path: str) -> List[str]:
+        pages = await asyncio.get_running_loop().run_in_executor(
+            self._get_executor(), read_pdf_text, pdf_path
+        )
+        with self.lock:
+            self.documents += 1
+        return pages
+
+    async def render(self, pdf_path: str, page_number: int) -> bytes:
+        start = time.monotonic()
+        png = await asyncio.get_running_loop().run_in_executor(
+            self._get_executor(), render_pdf_page, pdf_path, page_number, PDF_RENDER_DPI
+        )
+        with self.lock:
+            self.pages_rendered += 1
+            self.render_sec_total += time.monotonic() - start
+        return png
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "processes": self.processes,
+                "started": self.executor is not None,
+                "dpi": PDF_RENDER_DPI,
+                "text_layer": PDF_TEXT_LAYER,
+                "documents": self.documents,
+                "pages_rendered": self.pages_rendered,
+                "avg_render_ms": round(
+                    1000 * self.render_sec_total / self.pages_rendered, 1
+                ) if self.pages_rendered else 0.0,
+            }
+
+
+pdf_renderer = PdfRenderer(PDF_RENDER_PROCESSES)
+
+##########################################
+# DURABLE JOB QUEUE (POSTGRES, SKIP LOCKED)
+##########################################
+# "memory":   the API runs invoices on its own worker pool (lost on restart)
+# "postgres": the API enqueues, `python worker.py` processes; SPOOL_DIR must
+#             then be storage every worker can read (e.g. a shared volume)
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "memory").lower()
+if JOB_QUEUE_BACKEND not in ("memory", "postgres"):
+    raise RuntimeError("JOB_QUEUE_BACKEND must be 'memory' or 'postgres'")
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", 3))
+# A claimed item becomes visible to other workers again if its lease is not renewed
+QUEUE_LEASE_SEC = int(os.getenv("QUEUE_LEASE_SEC", 120))
+QUEUE_RETRY_BASE_SEC = float(os.getenv("QUEUE_RETRY_BASE_SEC", 10))
+QUEUE_RETRY_MAX_SEC = float(os.getenv("QUEUE_RETRY_MAX_SEC", 600))
+QUEUE_MAX_DEPTH = int(os.getenv("QUEUE_MAX_DEPTH", 5000))
+
+
+def is_retryable(exc: Exception) -> bool:
+    """Failures worth another attempt later: outages, throttling, DB hiccups."""
+    if isinstance(exc, (CircuitOpenError, DBPoolTimeout, psycopg2.OperationalError,
+                        httpx.TransportError, asyncio.TimeoutError)):
+        return True
+    status = status_code_of(exc)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def enqueue_invoices(cur, job_id: str, api_key: str, items: List[Dict]):
+    """Queue rows for one job, written with the caller's cursor (same transaction)."""
+    rows = [
+        (job_id, item["filename"], item["spool_path"], api_key, item["cache_key"],
+         Json(item["options"]), QUEUE_MAX_ATTEMPTS)
+        for item in items
+    ]
+    execute_values(cur, """
+        INSERT INTO invoice_queue (
+            job_id, filename, spool_path, api_key, cache_key, options, max_attempts
+        ) VALUES %s
+    """, rows, page_size=max(len(rows), 1))
+
+
+def enqueue_job_items(job_id: str, api_key: str, items: List[Dict]):
+    """enqueue_invoices in its own transaction, for items added after registration."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        enqueue_invoices(cur, job_id, api_key, items)
+        cur.close()
+
+
+def queue_has_room(count: int) -> bool:
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT count(*) FROM invoice_queue WHERE status IN ('queued', 'leased')")
+        depth = cur.fetchone()[0]
+        cur.close()
+    return depth + count <= QUEUE_MAX_DEPTH
+
+
+def claim_queue_items(owner: str, limit: int) -> List[Dict]:
+    """
+    Lease up to `limit` ready items: queued ones whose retry delay has passed,
+    and leased ones whose lease expired (their worker died). SKIP LOCKED lets
+    any number of workers claim concurrently without handing out an item twice.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            WITH ready AS (
+                SELECT id FROM invoice_queue
+                WHERE (status = 'queued' AND available_at <= now())
+                   OR (status = 'leased' AND lease_expires_at < now() AND attempts < max_attempts)
+                ORDER BY available_at, id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE invoice_queue q
+            SET status = 'leased',
+                lease_owner = %s,
+                lease_expires_at = now() + make_interval(secs => %s),
+                attempts = q.attempts + 1,
+                updated_at = now()
+            FROM ready
+            WHERE q.id = ready.id
+            RETURNING q.*
+        """, (limit, owner, QUEUE_LEASE_SEC))
+        rows = cur.fetchall()
+        cur.close()
+    return rows
+
+
+def renew_queue_leases(owner: str, ids: List[int]):
+    if not ids:
+        return
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE invoice_queue
+            SET lease_expires_at = now() + make_interval(secs => %s), updated_at = now()
+            WHERE id = ANY(%s) AND lease_owner = %s AND status = 'leased'
+        """, (QUEUE_LEASE_SEC, ids, owner))
+        cur.close()
+
+
+def finish_queue_item(item_id: int, owner: str, status: str, error: str = None):
+    """Terminal states: done, failed (not retryable) or dead (attempts exhausted)."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE invoice_queue
+            SET status = %s, last_error = %s, lease_owner = NULL,
+                lease_expires_at = NULL, updated_at = now()
+            WHERE id = %s AND lease_owner = %s
+        """, (status, error, item_id, owner))
+        cur.close()
+
+
+def retry_queue_item(item_id: int, owner: str, attempts: int, error: str):
+    """Back to queued, invisible for a jittered exponential delay."""
+    delay = min(QUEUE_RETRY_MAX_SEC, QUEUE_RETRY_BASE_SEC * 2 ** (attempts - 1))
+    delay = random.uniform(delay / 2, delay)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE invoice_queue
+            SET status = 'queued', last_error = %s, lease_owner = NULL, lease_expires_at = NULL,
+                available_at = now() + make_interval(secs => %s), updated_at = now()
+            WHERE id = %s AND lease_owner = %s
+        """, (error, delay, item_id, owner))
+        cur.close()
+    return delay
+
+
+def reap_dead_leases() -> int:
+    """Dead-letter items whose lease expired on their last attempt and fail their rows."""
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            UPDATE invoice_queue
+            SET status = 'dead', lease_owner = NULL, updated_at = now(),
+                last_error = 'Lease expired on final attempt'
+            WHERE status = 'leased' AND lease_expires_at < now() AND attempts >= max_attempts
+            RETURNING job_id, filename, api_key, spool_path
+        """)
+        rows = cur.fetchall()
+        cur.close()
+    for row in rows:
+        logger.error(f"Dead-lettered {row['job_id']}/{row['filename']}: lease expired")
+        fail_document(row["job_id"], row["filename"], row["api_key"])
+        discard_spool_file(row["spool_path"])
+    return len(rows)
+
+
+def queue_stats() -> Dict:
+    if JOB_QUEUE_BACKEND != "postgres":
+        return {"backend": JOB_QUEUE_BACKEND}
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT status, count(*) FROM invoice_queue GROUP BY status")
+            counts = dict(cur.fetchall())
+            cur.close()
+    except Exception as e:
+        return {"backend": JOB_QUEUE_BACKEND, "error": str(e)}
+    return {"backend": JOB_QUEUE_BACKEND, **counts}
+
+##########################################
+# EXTRACTION CACHE (IN-PROCESS LRU + POSTGRES)
+##########################################
+EXTRACTION_CACHE_ENABLED = os.getenv("EXTRACTION_CACHE_ENABLED", "true").lower() == "true"
+EXTRACTION_CACHE_TTL_SEC = int(os.getenv("EXTRACTION_CACHE_TTL_SEC", 7 * 24 * 3600))
+EXTRACTION_CACHE_MEMORY_ITEMS = int(os.getenv("EXTRACTION_CACHE_MEMORY_ITEMS", 1000))
+EXTRACTION_CACHE_DB_MAX_ROWS = int(os.getenv("EXTRACTION_CACHE_DB_MAX_ROWS", 100000))
+EXTRACTION_CACHE_PRUNE_EVERY = 100
+
+
+def extraction_fingerprint(options: Dict) -> str:
+    """Hash of everything besides the image that shapes the model output."""
+    preprocess_mode = options["preprocess_mode"]
+    material = json.dumps({
+        "prompt": PROMPT_VERSIONS[options["prompt_version"]].strip(),
+        "model_id": MODEL_ID,
+        "params": generation_params,
+        "preprocess": preprocess_mode,
+        "profile": PREPROCESS_PROFILE if preprocess_mode == "enhanced" else None,
+        "payload": payload_params if preprocess_mode != "none" else None,
+    }, sort_keys=True)
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+def extraction_cache_key(image_sha256: str, options: Dict) -> str:
+    fingerprint = extraction_fingerprint(options)
+    return hashlib.sha256(f"{image_sha256}:{fingerprint}".encode()).hexdigest()
+
+
+class ExtractionCache:
+    """
+    Two-tier cache of parsed extraction results. The in-process LRU answers
+    repeat uploads without I/O; the Postgres table shares results across
+    workers and restarts. Both tiers honour the TTL and a size cap.
+    """
+
+    def __init__(self, ttl_sec: int, memory_items: int, db_max_rows: int):
+        self.ttl_sec = ttl_sec
+        self.memory_items = memory_items
+        self.db_max_rows = db_max_rows
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.puts = 0
+
+    def _remember(self, key: str, data: Dict, stored_at: float):
+        with self.lock:
+            self.entries[key] = (stored_at, data)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.memory_items:
+                self.entries.popitem(last=False)
+
+    def get(self, key: str):
+        if not EXTRACTION_CACHE_ENABLED:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry[0] < self.ttl_sec:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self.entries[key]
+
+        try:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute("""
+                    UPDATE extraction_cache
+                    SET last_hit_at = now(), hit_count = hit_count + 1
+                    WHERE cache_key = %s
+                      AND created_at > now() - make_interval(secs => %s)
+                    RETURNING result, extract(epoch FROM created_at)
+                """, (key, self.ttl_sec))
+                row = cur.fetchone()
+                cur.close()
+        except Exception as e:
+            logger.warning(f"Extraction cache lookup failed: {e}")
+            row = None
+
+        if row is None:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        self._remember(key, row[0], float(row[1]))
+        with self.lock:
+            self.db_hits += 1
+        return row[0]
+
+    def put(self, key: str, data: Dict):
+        if not EXTRACTION_CACHE_ENABLED:
+            return
+
+        self._remember(key, data, time.time())
+        with self.lock:
+            self.puts += 1
+            prune = self.puts % EXTRACTION_CACHE_PRUNE_EVERY == 0
+
+        try:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute("""
+                    INSERT INTO extraction_cache (cache_key, result)
+                    VALUES (%s, %s)
+                    ON CONFLICT (cache_key) DO UPDATE
+                    SET result = EXCLUDED.result, created_at = now(), last_hit_at = now()
+                """, (key, Json(data)))
+                if prune:
+                    self._prune(cur)
+                cur.close()
+        except Exception as e:
+            logger.warning(f"Extraction cache store failed: {e}")
+
+    def _prune(self, cur):
+        cur.execute("""
+            DELETE FROM extraction_cache
+            WHERE created_at < now() - make_interval(secs => %s)
+        """, (self.ttl_sec,))
+        cur.execute("""
+            DELETE FROM extraction_cache
+            WHERE cache_key IN (
+                SELECT cache_key FROM extraction_cache
+                ORDER BY last_hit_at DESC
+                OFFSET %s
+            )
+        """, (self.db_max_rows,))
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "enabled": EXTRACTION_CACHE_ENABLED,
+                "memory_entries": len(self.entries),
+                "memory_hits": self.hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "stores": self.puts,
+            }
+
+
+extraction_cache = ExtractionCache(
+    EXTRACTION_CACHE_TTL_SEC,
+    EXTRACTION_CACHE_MEMORY_ITEMS,
+    EXTRACTION_CACHE_DB_MAX_ROWS
+)
+
+##########################################
+# NEAR-DUPLICATE DETECTION (PERCEPTUAL HASH INDEX)
+##########################################
+# "flag" annotates the result; "reuse" also skips the model when a match is
+# confirmed as the same image (e.g. re-encoded) from the same API key
+NEAR_DUP_POLICY = os.getenv("NEAR_DUP_POLICY", "flag").lower()  # reuse | flag | off
+NEAR_DUP_MAX_DISTANCE = int(os.getenv("NEAR_DUP_MAX_DISTANCE", 6))
+# Largest per-cell brightness change (0-255) on the 128x128 block_means grid
+# still treated as the same image; one changed digit moves a cell by ~10
+NEAR_DUP_REUSE_MAX_DIFF = int(os.getenv("NEAR_DUP_REUSE_MAX_DIFF", 4))
+NEAR_DUP_INDEX_MAX = int(os.getenv("NEAR_DUP_INDEX_MAX", 200000))
+
+
+class PerceptualHashIndex:
+    """
+    In-memory index of 64-bit dHashes for Hamming-distance lookups.
+
+    Hashes are split into `bands` equal chunks. Two hashes that differ in at
+    most bands - 1 bits must agree exactly on at least one chunk, so a lookup
+    only compares against entries sharing a chunk instead of the whole index.
+    """
+
+    def __init__(self, max_distance: int, max_entries: int):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.bands = next(b for b in (2, 4, 8, 16, 32, 64) if b > max_distance)
+        self.band_bits = 64 // self.bands
+        self.band_mask = (1 << self.band_bits) - 1
+        self.buckets = [defaultdict(set) for _ in range(self.bands)]
+        self.entries = OrderedDict()  # entry_id -> (hash, ref)
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.matches = 0
+
+    def _band_values(self, value: int):
+        return [
+            (value >> (i * self.band_bits)) & self.band_mask
+            for i in range(self.bands)
+        ]
+
+    def add(self, value: int, ref: Dict):
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = (value, ref)
+            for band, chunk in zip(self.buckets, self._band_values(value)):
+                band[chunk].add(entry_id)
+
+            while len(self.entries) > self.max_entries:
+                old_id, (old_value, _) = self.entries.popitem(last=False)
+                for band, chunk in zip(self.buckets, self._band_values(old_value)):
+                    band[chunk].discard(old_id)
+                    if not band[chunk]:
+                        del band[chunk]
+
+    def find(self, value: int, api_key: str):
+        """Returns (ref, distance) of the closest entry of `api_key` within range, else None."""
+        with self.lock:
+            self.lookups += 1
+            candidates = set()
+            for band, chunk in zip(self.buckets, self._band_values(value)):
+                candidates |= band.get(chunk, set())
+
+            best = None
+            for entry_id in candidates:
+                other, ref = self.entries[entry_id]
+                if ref["api_key"] != api_key:
+                    continue
+                distance = hamming_distance(value, other)
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = (ref, distance)
+
+            if best:
+                self.matches += 1
+            return best
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "policy": NEAR_DUP_POLICY,
+                "max_distance": self.max_distance,
+                "reuse_max_diff": NEAR_DUP_REUSE_MAX_DIFF,
+                "entries": len(self.entries),
+                "lookups": self.lookups,
+                "matches": self.matches,
+            }
+
+
+phash_index = PerceptualHashIndex(NEAR_DUP_MAX_DISTANCE, NEAR_DUP_INDEX_MAX)
+
+
+def _to_signed64(value: int) -> int:
+    # Postgres BIGINT is signed
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def remember_phash(value: int, detail: bytes, job_id: str, filename: str, cache_key: str,
+                   api_key: str):
+    ref = {"job_id": job_id, "filename": filename, "cache_key": cache_key, "api_key": api_key}
+    phash_index.add(value, ref)
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO invoice_phash (phash, cache_key, job_id, filename, api_key, detail)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, (_to_signed64(value), cache_key, job_id, filename, api_key,
+                  psycopg2.Binary(detail) if detail is not None else None))
+            cur.close()
+    except Exception as e:
+        logger.warning(f"Could not persist perceptual hash: {e}")
+
+
+def confirm_near_duplicate(ref: Dict, detail: bytes) -> bool:
+    """
+    Compare block_means fingerprints of a dHash match. The earlier one lives
+    only in Postgres (16 KB each), so it is fetched for the matched entry.
+    """
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT detail FROM invoice_phash
+                WHERE job_id = %s AND filename = %s AND api_key = %s AND detail IS NOT NULL
+                ORDER BY id DESC
+                LIMIT 1
+            """, (ref["job_id"], ref["filename"], ref["api_key"]))
+            row = cur.fetchone()
+            cur.close()
+    except Exception as e:
+        logger.warning(f"Could not load near-duplicate fingerprint: {e}")
+        return False
+    if row is None:
+        return False
+    return max_block_difference(bytes(row[0]), detail) <= NEAR_DUP_REUSE_MAX_DIFF
+
+
+def load_phash_index():
+    """Warm the in-memory index with the most recent hashes from Postgres."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT phash, cache_key, job_id, filename, api_key
+            FROM invoice_phash
+            ORDER BY id DESC
+            LIMIT %s
+        """, (NEAR_DUP_INDEX_MAX,))
+        rows = cur.fetchall()
+        cur.close()
+
+    # Oldest first so eviction order matches insertion order
+    for phash, cache_key, job_id, filename, api_key in reversed(rows):
+        phash_index.add(phash & ((1 << 64) - 1), {
+            "job_id": job_id, "filename": filename, "cache_key": cache_key, "api_key": api_key
+        })
+    logger.info(f"Loaded {len(rows)} perceptual hashes")
+
+##########################################
+# IMAGE PREPROCESSING (IN-MEMORY)
+##########################################
+PREPROCESS_MODES = ("none", "original", "enhanced")
+DEFAULT_PREPROCESS_MODE = os.getenv("PREPROCESS_MODE", "original").lower()
+# Profile used by "enhanced" mode: none | fast | full | auto (quality-based)
+PREPROCESS_PROFILE = os.getenv("PREPROCESS_PROFILE", "auto").lower()
+if PREPROCESS_PROFILE not in PREPROCESS_PROFILES:
+    raise RuntimeError(f"PREPROCESS_PROFILE must be one of {PREPROCESS_PROFILES}")
+
+# Applied to whatever image is sent (except in "none" mode) to cut request size
+payload_params = {
+    "enabled": os.getenv("PAYLOAD_OPTIMISE", "true").lower() == "true",
+    "max_edge": int(os.getenv("PAYLOAD_MAX_EDGE", 2000)),
+    "format": os.getenv("PAYLOAD_FORMAT", "jpeg").lower(),  # jpeg | webp
+    "quality": int(os.getenv("PAYLOAD_QUALITY", 85)),
+    "grayscale": os.getenv("PAYLOAD_GRAYSCALE", "false").lower() == "true",
+}
+
+PAYLOAD_ENCODINGS = {
+    "jpeg": (".jpg", "image/jpeg"),
+    "webp": (".webp", "image/webp"),
+    "png": (".png", "image/png"),
+}
+
+# Per-client override, keyed by the client name in VALID_API_KEYS
+CLIENT_PREPROCESS_MODES = {
+    "Mobile App Client": DEFAULT_PREPROCESS_MODE,
+}
+
+
+def resolve_preprocess_mode(x_api_key: str, requested: str = None) -> str:
+    mode = (requested or CLIENT_PREPROCESS_MODES.get(
+        VALID_API_KEYS[x_api_key], DEFAULT_PREPROCESS_MODE
+    )).lower()
+    if mode not in PREPROCESS_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid preprocess mode '{mode}', expected one of {list(PREPROCESS_MODES)}"
+        )
+    return mode
+
+
+def resolve_prompt_version(x_api_key: str, requested: str = None) -> str:
+    version = (requested or CLIENT_PROMPT_VERSIONS.get(
+        VALID_API_KEYS[x_api_key], DEFAULT_PROMPT_VERSION
+    )).lower()
+    if version not in PROMPT_VERSIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid prompt version '{version}', expected one of {list(PROMPT_VERSIONS)}"
+        )
+    return version
+
+
+def default_extraction_options() -> Dict:
+    return {
+        "preprocess_mode": DEFAULT_PREPROCESS_MODE,
+        "prompt_version": DEFAULT_PROMPT_VERSION,
+    }
+
+
+def guess_image_mime(content: bytes) -> str:
+    if content[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    return "image/jpeg"
+
+
+def prepare_image_payload(content: bytes, img, mode: str):
+    """
+    Returns (bytes, mime) to send to the model.
+
+    - none:     upload bytes untouched, never decoded
+    - original: upload bytes untouched (decoded only for hashing)
+    - enhanced: PREPROCESS_PROFILE applied, re-encoded in memory
+
+    Both decoded modes then go through optimise_payload.
+    """
+    if mode == "none":
+        return content, guess_image_mime(content)
+
+    if mode == "enhanced":
+        start = time.perf_counter()
+        processed, profile = preprocess_image(img, PREPROCESS_PROFILE)
+        logger.info(
+            f"Preprocessed with '{profile}' profile in "
+            f"{1000 * (time.perf_counter() - start):.0f} ms"
+        )
+        # Thresholded output is bilevel: PNG is smaller and free of JPEG ringing
+        return optimise_payload(processed, len(content), lossless=profile != "none")
+
+    payload, mime = optimise_payload(img, len(content))
+    if len(payload) >= len(content):
+        # Re-encoding did not help, send the upload as-is
+        return content, guess_image_mime(content)
+    return payload, mime
+
+
+def optimise_payload(img, original_size: int, params: Dict = None, lossless: bool = False):
+    """Downscale / grayscale / re-encode per payload_params and log the saving."""
+    params = params or payload_params
+    if not params["enabled"]:
+        ext, mime = PAYLOAD_ENCODINGS["png"]
+        return encode_image(img, ext), mime
+
+    img = shrink_to_max_edge(img, params["max_edge"])
+    if params["grayscale"]:
+        img = to_grayscale(img)
+
+    ext, mime = PAYLOAD_ENCODINGS["png" if lossless else params["format"]]
+    payload = encode_image(img, ext, quality=None if lossless else params["quality"])
+    logger.info(
+        f"Payload {original_size / 1024:.0f} KB -> {len(payload) / 1024:.0f} KB "
+        f"({mime}, {img.shape[1]}x{img.shape[0]})"
+    )
+    return payload, mime
+
+##########################################
+# UPLOAD SPOOLING (STREAMED, SIZE-LIMITED)
+##########################################
+# Point SPOOL_DIR at tmpfs (e.g. /dev/shm/invoice_spool) to keep spooled uploads off disk
+SPOOL_DIR = os.getenv("SPOOL_DIR", os.path.join(tempfile.gettempdir(), "invoice_spool"))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", 1024 * 1024))
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", 25 * 1024 * 1024))
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", 250 * 1024 * 1024))
+
+os.makedirs(SPOOL_DIR, exist_ok=True)
+
+
+async def spool_upload(file: UploadFile, request_budget: int,
+                       max_file_bytes: int = UPLOAD_MAX_FILE_BYTES):
+    """
+    Copies an upload to SPOOL_DIR chunk by chunk, hashing as it goes.
+    Returns (spool_path, sha256_hex, size). Raises 413 if the file or the
+    remaining request budget is exceeded. By now Starlette has already parsed
+    the multipart body into its own temp files, so this only limits what is
+    spooled; the request as a whole is bounded earlier by RequestBodyLimit.
+    """
+    sha = hashlib.sha256()
+    size = 0
+    spool_file = tempfile.NamedTemporaryFile(
+        dir=SPOOL_DIR,
+        delete=False,
+        suffix=os.path.splitext(file.filename or "")[1]
+    )
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_file_bytes:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"{file.filename} exceeds {max_file_bytes} bytes"
+                )
+            if size > request_budget:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Request exceeds {UPLOAD_MAX_REQUEST_BYTES} bytes"
+                )
+            sha.update(chunk)
+            spool_file.write(chunk)
+        spool_file.close()
+    except Exception:
+        spool_file.close()
+        discard_spool_file(spool_file.name)
+        raise
+    finally:
+        await file.close()
+
+    return spool_file.name, sha.hexdigest(), size
+
+
+def discard_spool_file(path: str):
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+def request_body_limit(path: str) -> int:
+    if path == "/extract-archive":
+        # The archive plus its multipart framing
+        return ARCHIVE_MAX_BYTES + UPLOAD_CHUNK_BYTES
+    return UPLOAD_MAX_REQUEST_BYTES
+
+
+class RequestBodyLimit:
+    """
+    ASGI middleware that counts body bytes as they are received. A declared
+    Content-Length over the limit is refused before reading anything; a
+    chunked body is cut off with 413 as soon as it passes the limit, instead
+    of after FastAPI has written the whole multipart body to temp files.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        limit = request_body_limit(scope["path"])
+        detail = f"Request exceeds {limit} bytes"
+        declared = Headers(scope=scope).get("content-length", "")
+        if declared.isdigit() and int(declared) > limit:
+            await JSONResponse({"detail": detail}, status_code=413)(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # FastAPI re-raises HTTPExceptions from body parsing as-is
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
 ##########################################
 # FASTAPI SETUP
 ##########################################
@@ -634,6 +1898,143 @@ app = FastAPI(
     redoc_url=None,
     openapi_url=None
 )
+app.add_middleware(RequestBodyLimit)
+
+##########################################
+# SCHEMA BOOTSTRAP (TABLES OWNED BY THIS SERVICE)
+##########################################
+SCHEMA_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS extraction_cache (
+        cache_key   TEXT PRIMARY KEY,
+        result      JSONB NOT NULL,
+        created_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+        last_hit_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        hit_count   INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS extraction_cache_last_hit_idx ON extraction_cache (last_hit_at)",
+    """
+    CREATE TABLE IF NOT EXISTS invoice_phash (
+        id          BIGSERIAL PRIMARY KEY,
+        phash       BIGINT NOT NULL,
+        cache_key   TEXT,
+        job_id      TEXT NOT NULL,
+        filename    TEXT NOT NULL,
+        created_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """,
+    "ALTER TABLE invoice_phash ADD COLUMN IF NOT EXISTS api_key TEXT",
+    "ALTER TABLE invoice_phash ADD COLUMN IF NOT EXISTS detail BYTEA",
+    "CREATE INDEX IF NOT EXISTS invoice_phash_ref_idx ON invoice_phash (job_id, filename)",
+    """
+    CREATE TABLE IF NOT EXISTS inference_usage (
+        id                BIGSERIAL PRIMARY KEY,
+        job_id            TEXT NOT NULL,
+        filename          TEXT NOT NULL,
+        call_kind         TEXT NOT NULL,
+        prompt_version    TEXT NOT NULL,
+        prompt_tokens     INTEGER NOT NULL DEFAULT 0,
+        completion_tokens INTEGER NOT NULL DEFAULT 0,
+        latency_ms        REAL,
+        created_at        TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """,
+    "ALTER TABLE inference_usage ADD COLUMN IF NOT EXISTS estimated BOOLEAN NOT NULL DEFAULT false",
+    """
+    CREATE TABLE IF NOT EXISTS invoice_queue (
+        id               BIGSERIAL PRIMARY KEY,
+        job_id           TEXT NOT NULL,
+        filename         TEXT NOT NULL,
+        spool_path       TEXT NOT NULL,
+        api_key          TEXT NOT NULL,
+        cache_key        TEXT,
+        options          JSONB NOT NULL,
+        status           TEXT NOT NULL DEFAULT 'queued',
+        attempts         INTEGER NOT NULL DEFAULT 0,
+        max_attempts     INTEGER NOT NULL,
+        available_at     TIMESTAMPTZ NOT NULL DEFAULT now(),
+        lease_owner      TEXT,
+        lease_expires_at TIMESTAMPTZ,
+        last_error       TEXT,
+        created_at       TIMESTAMPTZ NOT NULL DEFAULT now(),
+        updated_at       TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS invoice_queue_ready_idx ON invoice_queue (available_at) WHERE status = 'queued'",
+    "CREATE INDEX IF NOT EXISTS invoice_queue_lease_idx ON invoice_queue (lease_expires_at) WHERE status = 'leased'",
+    """
+    CREATE TABLE IF NOT EXISTS webhook_endpoints (
+        api_key     TEXT PRIMARY KEY,
+        url         TEXT NOT NULL,
+        secret      TEXT NOT NULL,
+        updated_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS webhook_deliveries (
+        id               BIGSERIAL PRIMARY KEY,
+        job_id           TEXT NOT NULL UNIQUE,
+        api_key          TEXT NOT NULL,
+        url              TEXT NOT NULL,
+        status           TEXT NOT NULL DEFAULT 'waiting',
+        attempts         INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+        lease_expires_at TIMESTAMPTZ,
+        response_status  INTEGER,
+        last_error       TEXT,
+        created_at       TIMESTAMPTZ NOT NULL DEFAULT now(),
+        delivered_at     TIMESTAMPTZ
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS webhook_deliveries_due_idx ON webhook_deliveries (next_attempt_at) WHERE status IN ('queued', 'delivering')",
+]
+
+
+def document_data_has_version() -> bool:
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema()
+              AND table_name = 'document_data' AND column_name = 'version'
+        """)
+        found = cur.fetchone() is not None
+        cur.close()
+    return found
+
+
+@app.on_event("startup")
+def bootstrap_schema():
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            for statement in SCHEMA_STATEMENTS:
+                cur.execute(statement)
+            cur.close()
+    except Exception as e:
+        logger.error(f"Schema bootstrap failed: {e}")
+
+    # document_data is shared with other services and is changed only by the
+    # migrations/ scripts; every status write bumps its version column
+    try:
+        has_version = document_data_has_version()
+    except Exception as e:
+        logger.error(f"Could not inspect document_data: {e}")
+    else:
+        if not has_version:
+            raise RuntimeError(
+                "document_data.version is missing; apply migrations/001_document_data_version.sql"
+            )
+
+    if NEAR_DUP_POLICY != "off":
+        try:
+            load_phash_index()
+        except Exception as e:
+            logger.error(f"Perceptual hash index warm-up failed: {e}")
+
+    if WEBHOOKS_ENABLED:
+        webhook_dispatcher.start()
 
 ##########################################
 # REQUEST LOGGING MIDDLEWARE (HTTPS REQUESTS)
@@ -650,6 +2051,20 @@ async def job_context(request: Request, call_next):
     response.headers["X-Job-Id"] = job_id
     return response
 
+@app.on_event("shutdown")
+async def close_inference_client():
+    await watsonx_client.aclose()
+
+
+@app.exception_handler(DBPoolTimeout)
+async def db_pool_timeout_handler(request: Request, exc: DBPoolTimeout):
+    logger.error(f"DB pool exhausted: {exc}")
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Database busy, please retry later"},
+        headers={"Retry-After": "5"}
+    )
+
 ##########################################
 # ROOT & HEALTH
 ##########################################
@@ -663,20 +2078,130 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    breaker = inference_breaker.stats()
+    return {
+        "status": "healthy" if breaker["state"] == "closed" else "degraded",
+        "circuit_breaker": breaker,
+        "workers": worker_pool.stats(),
+        "inference": inference_stats(),
+        "rate_limit": rate_limiter.stats(),
+        "job_queue": await worker_pool.run_blocking(queue_stats),
+        "db_pool": db_pool.stats(),
+        "extraction_cache": extraction_cache.stats(),
+        "near_duplicates": phash_index.stats(),
+        "token_usage": usage_stats()
+    }
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "workers": worker_pool.stats(),
+        "inference": inference_stats(),
+        "rate_limit": rate_limiter.stats(),
+        "job_queue": await worker_pool.run_blocking(queue_stats),
+        "job_events": job_status_listener.stats(),
+        "webhooks": webhook_dispatcher.stats(),
+        "circuit_breaker": inference_breaker.stats(),
+        "db_pool": db_pool.stats(),
+        "pdf": pdf_renderer.stats(),
+        "extraction_cache": extraction_cache.stats(),
+        "near_duplicates": phash_index.stats()
+    }
 
 ##########################################
 # ROBUST JSON PARSER
 ##########################################
-def parse_json_robust(raw_text: str) -> Dict:
+class MalformedOutputError(ValueError):
+    pass
+
+
+def parse_json_robust(raw_text: str, repairs: List[str] = None) -> Dict:
+    """
+    The JSON object in a model response. Repairs that change no value are
+    applied and described in `repairs` (when given); output that would need
+    data dropped or guessed raises MalformedOutputError.
+    """
     try:
         return json.loads(raw_text)
-    except:
-        cleaned = re.sub(r"```json|```", "", raw_text).strip()
-        start, end = cleaned.find("{"), cleaned.rfind("}")
-        if start != -1 and end != -1:
+    except ValueError:
+        pass
+
+    cleaned = re.sub(r"```json|```", "", raw_text).strip()
+    start, end = cleaned.find("{"), cleaned.rfind("}")
+    if start != -1 and end > start:
+        try:
             return json.loads(cleaned[start:end + 1])
-    return {}
+        except ValueError:
+            pass
+
+    repaired = repair_json(cleaned, repairs)
+    if repaired is not None:
+        return repaired
+    raise MalformedOutputError("No parsable JSON object in model output")
+
+
+def repair_json(text: str, repairs: List[str] = None):
+    """
+    Lossless repair of almost-valid JSON: drops trailing commas before a
+    closing bracket and, for output cut off between values, closes whatever
+    brackets are still open. Returns None when that is not enough, rather
+    than cutting the text back to something parsable and losing fields.
+    """
+    start = text.find("{")
+    if start == -1:
+        return None
+
+    out, stack = [], []
+    in_string = escape = False
+    commas = 0
+    for ch in text[start:]:
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            # Trailing comma: the last non-blank character before the closer
+            last = len(out) - 1
+            while last >= 0 and out[last].isspace():
+                last -= 1
+            if last >= 0 and out[last] == ",":
+                del out[last]
+                commas += 1
+            if stack:
+                stack.pop()
+            if not stack:
+                out.append(ch)
+                break
+        out.append(ch)
+
+    if in_string:
+        return None
+    closers = "".join(reversed(stack))
+    body = "".join(out).rstrip()
+    if closers and body.endswith(","):
+        body = body[:-1]
+        commas += 1
+
+    try:
+        data = json.loads(body + closers)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    if repairs is not None:
+        if commas:
+            repairs.append(f"removed {commas} trailing comma(s)")
+        if closers:
+            repairs.append(f"closed {len(closers)} bracket(s) of cut-off output")
+    return data
 
 
 ##########################################
@@ -729,33 +2254,1281 @@ def audit_extracted_fields(data: Dict):
 
 
 ##########################################
-# CORE EXTRACTION
+# OUTPUT TOKEN BUDGET
 ##########################################
-def extract_invoice_from_path(image_path: str) -> Dict:
-    with open(image_path, "rb") as f:
-        img_b64 = base64.b64encode(f.read()).decode()
+# generation_params["max_new_tokens"] is the hard ceiling; per-invoice budgets sit below it
+MAX_NEW_TOKENS_CAP = generation_params["max_new_tokens"]
+OUTPUT_BUDGET_ADAPTIVE = os.getenv("OUTPUT_BUDGET_ADAPTIVE", "true").lower() == "true"
+OUTPUT_BUDGET_BASE = int(os.getenv("OUTPUT_BUDGET_BASE", 1000))
+OUTPUT_BUDGET_PER_LINE = int(os.getenv("OUTPUT_BUDGET_PER_LINE", 40))
+OUTPUT_BUDGET_MIN = int(os.getenv("OUTPUT_BUDGET_MIN", 1500))
+# Truncated outputs are finished by short continuation calls instead of a full re-run
+CONTINUATION_ROUNDS = int(os.getenv("CONTINUATION_ROUNDS", 2))
+CONTINUATION_MAX_TOKENS = int(os.getenv("CONTINUATION_MAX_TOKENS", 2000))
+
+continuation_prompt = (
+    "Your previous answer was cut off. Continue the JSON exactly from the last "
+    "character you wrote. Output ONLY the missing remainder: no repetition, "
+    "no markdown, no explanation."
+)
+
+
+class TruncatedOutputError(Exception):
+    pass
+
+
+def estimate_output_budget(img) -> int:
+    """
+    max_new_tokens for one invoice, scaled by the number of text lines on the
+    page (header JSON plus a per-line allowance for item rows).
+    """
+    if not OUTPUT_BUDGET_ADAPTIVE or img is None:
+        return MAX_NEW_TOKENS_CAP
+    lines = estimate_text_lines(to_grayscale(img))
+    budget = OUTPUT_BUDGET_BASE + OUTPUT_BUDGET_PER_LINE * lines
+    return max(OUTPUT_BUDGET_MIN, min(MAX_NEW_TOKENS_CAP, budget))
+
+
+def is_runaway(raw: str, tail: int = 200, repeats: int = 3) -> bool:
+    """
+    A generation that hit its budget while looping: the last `tail` chars
+    already occur `repeats` times. Genuine item lists differ in IMEIs and
+    amounts, so their tails do not repeat verbatim.
+    """
+    if len(raw) < tail * repeats:
+        return False
+    return raw.count(raw[-tail:]) >= repeats
+
+##########################################
+# ASYNC INFERENCE CLIENT
+##########################################
+CHAT_PARAM_KEYS = (
+    "max_tokens", "temperature", "top_p", "frequency_penalty",
+    "presence_penalty", "stop", "seed", "time_limit"
+)
+
+
+def loop_local(store, factory):
+    """
+    asyncio primitives and httpx clients are bound to one event loop. Keep one
+    per loop so the API and blocking wrappers (asyncio.run) can share code.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in store:
+        store[loop] = factory()
+    return store[loop]
+
+
+def to_chat_params(params: Dict) -> Dict:
+    """generation_params uses text-generation names; the chat API wants max_tokens."""
+    chat = {k: v for k, v in params.items() if k in CHAT_PARAM_KEYS}
+    if "max_new_tokens" in params:
+        chat["max_tokens"] = params["max_new_tokens"]
+    return chat
+
+
+class WatsonxChatClient:
+    """
+    Minimal async client for the watsonx.ai chat endpoint with IAM API-key
+    auth. Point IBM_SERVICE_URL / IBM_IAM_URL at stub_server.py to run it
+    locally without watsonx.
+    """
+
+    def __init__(self, service_url: str, api_key: str, project_id: str, model_id: str,
+                 iam_url: str, timeout: float):
+        self.service_url = service_url.rstrip("/")
+        self.api_key = api_key
+        self.project_id = project_id
+        self.model_id = model_id
+        self.iam_url = iam_url
+        self.timeout = timeout
+        self.loops = weakref.WeakKeyDictionary()
+        self.token = None
+        self.token_expiry = 0.0
+
+    def _http(self):
+        return loop_local(self.loops, lambda: (
+            httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=INFERENCE_CONCURRENCY * 2)
+            ),
+            asyncio.Lock()
+        ))
+
+    async def _token(self) -> str:
+        http, lock = self._http()
+        async with lock:
+            if self.token and time.time() < self.token_expiry - 60:
+                return self.token
+            resp = await http.post(
+                self.iam_url,
+                data={
+                    "grant_type": "urn:ibm:params:oauth:grant-type:apikey",
+                    "apikey": self.api_key
+                },
+                headers={"Accept": "application/json"}
+            )
+            resp.raise_for_status()
+            body = resp.json()
+            self.token = body["access_token"]
+            self.token_expiry = float(
+                body.get("expiration") or time.time() + body.get("expires_in", 3600)
+            )
+            return self.token
+
+    async def chat(self, messages: List[Dict], params: Dict) -> Dict:
+        http, _ = self._http()
+        token = await self._token()
+        resp = await http.post(
+            f"{self.service_url}/ml/v1/text/chat",
+            params={"version": CHAT_API_VERSION},
+            json={
+                "model_id": self.model_id,
+                "project_id": self.project_id,
+                "messages": messages,
+                **params
+            },
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        if resp.status_code == 401:
+            # Token revoked or expired early; fetch a new one on the next attempt
+            self.token = None
+        resp.raise_for_status()
+        return resp.json()
+
+    async def chat_stream(self, messages: List[Dict], params: Dict):
+        """Yields the parsed `data:` events of /ml/v1/text/chat_stream (SSE)."""
+        http, _ = self._http()
+        token = await self._token()
+        async with http.stream(
+            "POST",
+            f"{self.service_url}/ml/v1/text/chat_stream",
+            params={"version": CHAT_API_VERSION},
+            json={
+                "model_id": self.model_id,
+                "project_id": self.project_id,
+                "messages": messages,
+                **params
+            },
+            headers={"Authorization": f"Bearer {token}", "Accept": "text/event-stream"}
+        ) as resp:
+            if resp.status_code == 401:
+                self.token = None
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if not data or data == "[DONE]":
+                    continue
+                yield json.loads(data)
+
+    async def aclose(self):
+        loop = asyncio.get_running_loop()
+        if loop in self.loops:
+            http, _ = self.loops.pop(loop)
+            await http.aclose()
+
+
+watsonx_client = WatsonxChatClient(
+    SERVICE_URL, API_KEY, PROJECT_ID, MODEL_ID, IAM_URL, INFERENCE_TIMEOUT_SEC
+)
+
+##########################################
+# PROVIDER RATE LIMIT (TOKEN BUCKETS)
+##########################################
+# watsonx quotas for the whole project; 0 disables a bucket. Each process
+# enforces its share: RATE_LIMIT_PROCESSES is the number of processes making
+# model calls against the project (uvicorn workers in memory mode, worker.py
+# processes in postgres mode, where the API itself makes none).
+RATE_LIMIT_PROCESSES = max(1, int(os.getenv("RATE_LIMIT_PROCESSES", 1)))
+RATE_LIMIT_RPS = float(os.getenv("RATE_LIMIT_RPS", 8)) / RATE_LIMIT_PROCESSES
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", 8)) / RATE_LIMIT_PROCESSES
+RATE_LIMIT_TPM = float(os.getenv("RATE_LIMIT_TPM", 0)) / RATE_LIMIT_PROCESSES
+RATE_LIMIT_TOKENS_PER_CALL = float(os.getenv("RATE_LIMIT_TOKENS_PER_CALL", 4000))
+RETRY_BACKOFF_BASE_SEC = float(os.getenv("RETRY_BACKOFF_BASE_SEC", 1.0))
+RETRY_BACKOFF_MAX_SEC = float(os.getenv("RETRY_BACKOFF_MAX_SEC", 30.0))
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. reserve() takes the tokens right away (the level
+    may go negative) and returns how long the caller must wait, so concurrent
+    callers are spaced out in arrival order instead of all retrying at once.
+    """
+
+    def __init__(self, rate_per_sec: float, capacity: float):
+        self.rate = rate_per_sec
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        with self.lock:
+            self._refill(time.monotonic())
+            self.level -= amount
+            return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount: float):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.level = min(self.capacity, self.level + amount)
+
+
+def retry_after_of(exc: Exception):
+    """Retry-After (seconds) of a provider error, from httpx or SDK exceptions alike."""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+def status_code_of(exc: Exception):
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None) or getattr(exc, "status_code", None)
+
+
+class ProviderRateLimiter:
+    """
+    One limiter for every model call in the process (all worker tasks and
+    event loops): requests per second plus tokens per minute. Token use is
+    reserved from a running average before the call and settled against the
+    provider-reported usage afterwards. A 429 with Retry-After pauses
+    everyone, not just the caller that saw it.
+    """
+
+    def __init__(self, rps: float, burst: float, tpm: float, tokens_per_call: float):
+        self.requests = TokenBucket(rps, max(1.0, burst)) if rps > 0 else None
+        self.tokens = TokenBucket(tpm / 60.0, tpm) if tpm > 0 else None
+        self.tokens_per_call = tokens_per_call
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+        self.waits = 0
+        self.wait_sec = 0.0
+        self.throttled = 0
+
+    async def acquire(self) -> float:
+        """Wait for a slot; returns the token estimate to pass to settle()."""
+        estimate = self.tokens_per_call
+        wait = max(0.0, self.paused_until - time.monotonic())
+        if self.requests:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens:
+            wait = max(wait, self.tokens.reserve(estimate))
+        if wait > 0:
+            with self.lock:
+                self.waits += 1
+                self.wait_sec += wait
+            await asyncio.sleep(wait)
+        return estimate
+
+    def settle(self, estimate: float, usage: Dict = None):
+        actual = (usage or {}).get("total_tokens") or sum(
+            (usage or {}).get(k, 0) for k in ("prompt_tokens", "completion_tokens")
+        )
+        if self.tokens:
+            # Positive difference returns unused reservation, negative charges the overrun
+            self.tokens.refund(estimate - actual)
+        if actual:
+            with self.lock:
+                self.tokens_per_call = 0.8 * self.tokens_per_call + 0.2 * actual
+
+    def backoff(self, attempt: int, exc: Exception) -> float:
+        """Full-jitter exponential backoff, never shorter than the provider's Retry-After."""
+        delay = random.uniform(0, min(RETRY_BACKOFF_MAX_SEC, RETRY_BACKOFF_BASE_SEC * 2 ** attempt))
+        retry_after = retry_after_of(exc)
+        if status_code_of(exc) == 429:
+            with self.lock:
+                self.throttled += 1
+                if retry_after is not None:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        if retry_after is not None:
+            delay = retry_after + random.uniform(0, RETRY_BACKOFF_BASE_SEC)
+        return delay
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "processes": RATE_LIMIT_PROCESSES,
+                "rps": round(RATE_LIMIT_RPS, 2),
+                "tpm": round(RATE_LIMIT_TPM),
+                "tokens_per_call": round(self.tokens_per_call),
+                "waits": self.waits,
+                "wait_sec": round(self.wait_sec, 1),
+                "throttled": self.throttled,
+                "paused_for_sec": round(max(0.0, self.paused_until - time.monotonic()), 1),
+            }
+
+
+rate_limiter = ProviderRateLimiter(
+    RATE_LIMIT_RPS, RATE_LIMIT_BURST, RATE_LIMIT_TPM, RATE_LIMIT_TOKENS_PER_CALL
+)
+logger.info(
+    f"Provider rate limit for this process (1/{RATE_LIMIT_PROCESSES} of the quota): "
+    f"{RATE_LIMIT_RPS:.2f} rps (0 = off), burst {max(1.0, RATE_LIMIT_BURST):.1f}, "
+    f"{RATE_LIMIT_TPM:.0f} tpm (0 = off)"
+)
 
-    mime = "image/jpeg" if image_path.lower().endswith(("jpg", "jpeg")) else "image/png"
+##########################################
+# CIRCUIT BREAKER (INFERENCE BACKEND)
+##########################################
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_SEC = float(os.getenv("CIRCUIT_RESET_SEC", 30))
+CIRCUIT_HALF_OPEN_CALLS = int(os.getenv("CIRCUIT_HALF_OPEN_CALLS", 1))
+# A half-open trial without an outcome after this long counts as failed
+CIRCUIT_TRIAL_TIMEOUT_SEC = float(os.getenv("CIRCUIT_TRIAL_TIMEOUT_SEC", INFERENCE_TIMEOUT_SEC + 30))
+# While open: "fail" fails invoices at once, "wait" keeps them queued until a trial call succeeds
+CIRCUIT_OPEN_POLICY = os.getenv("CIRCUIT_OPEN_POLICY", "fail").lower()
+if CIRCUIT_OPEN_POLICY not in ("fail", "wait"):
+    raise RuntimeError("CIRCUIT_OPEN_POLICY must be 'fail' or 'wait'")
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_provider_failure(exc: Exception) -> bool:
+    """Outage-type errors: timeouts, connection errors and 5xx. 4xx is about the request."""
+    status = status_code_of(exc)
+    return status is None or status >= 500
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `threshold` consecutive provider failures; open ->
+    half-open after `reset_sec`, letting `half_open_calls` trial calls through;
+    a trial success closes it again, a trial failure re-opens it, and so does
+    a trial that reports nothing within `trial_timeout_sec`.
+    """
+
+    def __init__(self, threshold: int, reset_sec: float, half_open_calls: int, policy: str,
+                 trial_timeout_sec: float = CIRCUIT_TRIAL_TIMEOUT_SEC):
+        self.threshold = threshold
+        self.reset_sec = reset_sec
+        self.half_open_calls = half_open_calls
+        self.policy = policy
+        self.trial_timeout_sec = trial_timeout_sec
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.half_opened_at = 0.0
+        self.trials = 0
+        self.times_opened = 0
+        self.rejected = 0
+
+    def _open(self, now: float):
+        self.state, self.opened_at = "open", now
+        self.times_opened += 1
+
+    def _admit(self):
+        """
+        (wait, trial): wait is 0 if the call may go ahead, else seconds until
+        it might; trial says whether the call took a half-open trial slot.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if (self.state == "half_open" and self.trials >= self.half_open_calls
+                    and now - self.half_opened_at >= self.trial_timeout_sec):
+                self._open(now)
+                logger.error("Circuit breaker re-opened: half-open trial timed out")
+            if self.state == "open" and now - self.opened_at >= self.reset_sec:
+                self.state, self.trials, self.half_opened_at = "half_open", 0, now
+                logger.warning("Circuit breaker half-open, sending trial call")
+            if self.state == "closed":
+                return 0.0, False
+            if self.state == "half_open" and self.trials < self.half_open_calls:
+                self.trials += 1
+                return 0.0, True
+            self.rejected += 1
+            return max(1.0, self.opened_at + self.reset_sec - now), False
+
+    async def before_call(self) -> bool:
+        """Waits for or refuses admission; returns whether the call is a half-open trial."""
+        while True:
+            wait, trial = self._admit()
+            if wait == 0.0:
+                return trial
+            if self.policy == "fail":
+                raise CircuitOpenError(f"Inference backend unavailable (circuit {self.state})")
+            await asyncio.sleep(wait + random.uniform(0, 1.0))
+
+    def record(self, exc: Exception = None):
+        with self.lock:
+            if exc is None or not is_provider_failure(exc):
+                if self.state != "closed":
+                    logger.info("Circuit breaker closed")
+                self.state, self.failures = "closed", 0
+                return
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+                self._open(time.monotonic())
+                logger.error(f"Circuit breaker opened after {self.failures} failure(s): {exc}")
+
+    def release(self, trial: bool):
+        """A call was cancelled before it had an outcome; hand its trial slot back."""
+        with self.lock:
+            if trial and self.state == "half_open" and self.trials > 0:
+                self.trials -= 1
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "state": self.state,
+                "policy": self.policy,
+                "consecutive_failures": self.failures,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+            }
+
+
+inference_breaker = CircuitBreaker(
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SEC, CIRCUIT_HALF_OPEN_CALLS, CIRCUIT_OPEN_POLICY
+)
+
+
+##########################################
+# ADAPTIVE CONCURRENCY (AIMD)
+##########################################
+AIMD_ENABLED = os.getenv("AIMD_ENABLED", "true").lower() == "true"
+AIMD_MIN_CONCURRENCY = int(os.getenv("AIMD_MIN_CONCURRENCY", 2))
+AIMD_INITIAL_CONCURRENCY = int(os.getenv("AIMD_INITIAL_CONCURRENCY", max(AIMD_MIN_CONCURRENCY, INFERENCE_CONCURRENCY // 2)))
+AIMD_INCREASE = float(os.getenv("AIMD_INCREASE", 1))
+AIMD_DECREASE = float(os.getenv("AIMD_DECREASE", 0.7))
+# Window latency above baseline * tolerance, or error rate above the max, counts as degraded
+AIMD_LATENCY_TOLERANCE = float(os.getenv("AIMD_LATENCY_TOLERANCE", 2.0))
+AIMD_MAX_ERROR_RATE = float(os.getenv("AIMD_MAX_ERROR_RATE", 0.1))
+AIMD_WINDOW = int(os.getenv("AIMD_WINDOW", 20))
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    Process-wide limit on concurrent model calls, shared across event loops.
+    Every AIMD_WINDOW completed calls the window's median latency and error
+    rate are compared with the healthy baseline: healthy and busy -> limit +
+    AIMD_INCREASE, degraded -> limit * AIMD_DECREASE. With AIMD off the limit
+    stays at INFERENCE_CONCURRENCY.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, adaptive: bool):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.adaptive = adaptive
+        self.limit = float(min(maximum, max(minimum, initial)) if adaptive else maximum)
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.waiters = deque()
+        self.lock = threading.Lock()
+        self.window = []
+        self.baseline_ms = None
+        self.increases = 0
+        self.decreases = 0
+        self.decisions = deque(maxlen=20)
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if not self.waiters and self.in_flight < int(self.limit):
+                self._take()
+                return
+            waiter = loop.create_future()
+            self.waiters.append((loop, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self.lock:
+                queued = (loop, waiter) in self.waiters
+                if queued:
+                    self.waiters.remove((loop, waiter))
+            if not queued and waiter.done() and not waiter.cancelled():
+                # Granted, then cancelled before resuming: give the slot back.
+                # (A waiter cancelled before _grant ran is released by _grant.)
+                self.release()
+            raise
+
+    def _take(self):
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def _wake(self):
+        while self.waiters and self.in_flight < int(self.limit):
+            loop, waiter = self.waiters.popleft()
+            self._take()
+            loop.call_soon_threadsafe(self._grant, waiter)
+
+    def _grant(self, waiter):
+        if waiter.cancelled():
+            self.release()
+        else:
+            waiter.set_result(None)
+
+    def release(self, latency_ms: float = None, failed: bool = False):
+        with self.lock:
+            self.in_flight -= 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            if latency_ms is not None and self.adaptive:
+                self.window.append((latency_ms, failed))
+                if len(self.window) >= AIMD_WINDOW:
+                    self._adjust()
+            self._wake()
+
+    def _adjust(self):
+        latencies = sorted(latency for latency, failed in self.window if not failed)
+        error_rate = sum(failed for _, failed in self.window) / len(self.window)
+        median = latencies[len(latencies) // 2] if latencies else None
+        busy = self.peak_in_flight >= int(self.limit)
+        self.window, self.peak_in_flight = [], self.in_flight
+
+        if error_rate > AIMD_MAX_ERROR_RATE:
+            action, reason = "decrease", f"error rate {error_rate:.0%}"
+        elif median is not None and self.baseline_ms and median > self.baseline_ms * AIMD_LATENCY_TOLERANCE:
+            action, reason = "decrease", f"p50 {median:.0f} ms vs baseline {self.baseline_ms:.0f} ms"
+        elif busy:
+            action, reason = "increase", "healthy at limit"
+        else:
+            action, reason = "hold", "healthy below limit"
+
+        # Baseline tracks the fastest healthy windows, creeping up 1% per window
+        # so a lasting shift in provider speed is eventually accepted
+        if median is not None:
+            self.baseline_ms = median if self.baseline_ms is None else min(median, self.baseline_ms * 1.01)
+
+        previous = self.limit
+        if action == "increase":
+            self.limit = min(self.maximum, self.limit + AIMD_INCREASE)
+        elif action == "decrease":
+            self.limit = max(self.minimum, self.limit * AIMD_DECREASE)
+            logger.warning(f"Inference concurrency {previous:.0f} -> {self.limit:.0f}: {reason}")
+        if int(self.limit) != int(previous):
+            self.increases += action == "increase"
+            self.decreases += action == "decrease"
+        self.decisions.append({
+            "at": datetime.now().isoformat(timespec="seconds"),
+            "action": action,
+            "reason": reason,
+            "limit": int(self.limit),
+        })
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "adaptive": self.adaptive,
+                "limit": int(self.limit),
+                "min": self.minimum,
+                "max": self.maximum,
+                "in_flight": self.in_flight,
+                "waiting": len(self.waiters),
+                "baseline_latency_ms": round(self.baseline_ms) if self.baseline_ms else None,
+                "increases": self.increases,
+                "decreases": self.decreases,
+                "recent_decisions": list(self.decisions),
+            }
+
+
+concurrency_limit = AdaptiveConcurrencyLimit(
+    AIMD_INITIAL_CONCURRENCY, AIMD_MIN_CONCURRENCY, INFERENCE_CONCURRENCY, AIMD_ENABLED
+)
+
+
+async def chat_completion(messages: List[Dict], params: Dict, on_partial=None,
+                          prefix: str = "", spent: Dict = None) -> Dict:
+    """
+    One model call, within the adaptive concurrency limit. Always returns a
+    chat-completion shaped dict, streamed or not. `prefix` is the text a
+    continuation call is extending. If the call is cancelled after it was
+    sent, the provider has still charged for it: the token reservation is
+    kept and the estimated usage is written to `spent` (when given).
+    """
+    trial = await inference_breaker.before_call()
+    estimate = None
+    try:
+        estimate = await rate_limiter.acquire()
+        await concurrency_limit.acquire()
+    except BaseException:
+        # Cancelled while queued (e.g. a losing hedge): no outcome to report,
+        # so hand back the trial slot and the token reservation
+        inference_breaker.release(trial)
+        if estimate is not None:
+            rate_limiter.settle(estimate)
+        raise
+    response, latency_ms, failed, abandoned = None, None, False, None
+    started = time.perf_counter()
+    try:
+        if INFERENCE_BACKEND == "sdk":
+            response = await asyncio.to_thread(model.chat, messages=messages, params=params)
+        elif INFERENCE_STREAMING:
+            response = await chat_completion_stream(messages, params, on_partial, prefix)
+        else:
+            response = await watsonx_client.chat(messages, to_chat_params(params))
+        inference_breaker.record()
+        latency_ms = 1000 * (time.perf_counter() - started)
+        usage = response.get("usage") or {}
+        if not usage.get("estimated"):
+            prompt_estimator.observe(messages, usage.get("prompt_tokens", 0))
+        return response
+    except asyncio.CancelledError:
+        inference_breaker.release(trial)
+        prompt_tokens = prompt_estimator.estimate(messages)
+        abandoned = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": max(0, round(estimate) - prompt_tokens),
+            "estimated": True
+        }
+        if spent is not None:
+            spent.update(abandoned)
+        raise
+    except Exception as e:
+        inference_breaker.record(e)
+        failed = is_provider_failure(e) or status_code_of(e) == 429
+        latency_ms = 1000 * (time.perf_counter() - started) if failed else None
+        raise
+    finally:
+        concurrency_limit.release(latency_ms, failed)
+        rate_limiter.settle(estimate, (response or {}).get("usage") or abandoned)
+
+
+def inference_stats() -> Dict:
+    return {
+        "backend": INFERENCE_BACKEND,
+        "streaming": INFERENCE_STREAMING,
+        "concurrency": concurrency_limit.stats(),
+        "hedging": hedger.stats(),
+        "streams_stopped_early": streams_stopped_early,
+        "prompt_tokens_per_image": round(prompt_estimator.tokens_per_image),
+    }
+
+##########################################
+# HEDGED REQUESTS (TAIL LATENCY)
+##########################################
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+# A second identical call fires once the first is slower than this percentile of recent calls
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 95))
+# Hedges may add at most this share of extra calls
+HEDGE_BUDGET_PCT = float(os.getenv("HEDGE_BUDGET_PCT", 5))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", 20))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", 200))
+
+
+class RequestHedger:
+    """
+    Runs a model call and, if it outlives the HEDGE_PERCENTILE latency of
+    recent calls, starts an identical one; the first to succeed wins and the
+    other is cancelled. Hedges stay within HEDGE_BUDGET_PCT of all calls and
+    are skipped while calls are queueing for a concurrency slot.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.latencies = deque(maxlen=HEDGE_WINDOW)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def threshold_sec(self):
+        with self.lock:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE / 100))]
+
+    def _may_hedge(self) -> bool:
+        with self.lock:
+            if (self.hedges + 1) * 100 > HEDGE_BUDGET_PCT * self.calls:
+                return False
+            if concurrency_limit.waiters:
+                return False
+            self.hedges += 1
+            return True
+
+    async def run(self, messages: List[Dict], params: Dict, on_partial=None, prefix: str = "",
+                  cancelled_usage: List[Dict] = None) -> Dict:
+        """
+        The winning response. Estimated usage of each call cancelled after it
+        was sent (the loser) is appended to `cancelled_usage`.
+        """
+        started = time.perf_counter()
+        with self.lock:
+            self.calls += 1
+        threshold = self.threshold_sec() if self.enabled else None
+
+        spent = {}
+        primary = asyncio.ensure_future(
+            chat_completion(messages, params, on_partial, prefix, spent.setdefault("primary", {}))
+        )
+        pending, winner = {primary}, None
+        try:
+            if threshold is not None:
+                done, _ = await asyncio.wait(pending, timeout=threshold)
+                if not done and self._may_hedge():
+                    logger.info(f"Hedging model call after {threshold:.1f}s")
+                    pending.add(asyncio.ensure_future(
+                        chat_completion(messages, params, None, prefix, spent.setdefault("hedge", {}))
+                    ))
+
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        break
+                    error = task.exception()
+                if winner:
+                    break
+            if winner is None:
+                raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                # Let the losers settle their reservations before reporting them
+                await asyncio.wait(pending)
+            if cancelled_usage is not None:
+                cancelled_usage.extend(usage for usage in spent.values() if usage)
+
+        with self.lock:
+            self.latencies.append(time.perf_counter() - started)
+            self.hedge_wins += winner is not primary
+        return winner.result()
+
+    def stats(self) -> Dict:
+        threshold = self.threshold_sec()
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "threshold_sec": round(threshold, 2) if threshold is not None else None,
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+            }
+
+
+hedger = RequestHedger(HEDGE_ENABLED)
+
+##########################################
+# STREAMING GENERATION (INCREMENTAL JSON + EARLY STOP)
+##########################################
+INFERENCE_STREAMING = os.getenv("INFERENCE_STREAMING", "true").lower() == "true"
+PARTIAL_UPDATE_INTERVAL_SEC = float(os.getenv("PARTIAL_UPDATE_INTERVAL_SEC", 2.0))
+# Starting cost of one image in the prompt, until provider-reported usage calibrates it
+PROMPT_TOKENS_PER_IMAGE = float(os.getenv("PROMPT_TOKENS_PER_IMAGE", 1500))
+streams_stopped_early = 0
+
+
+class PromptTokenEstimator:
+    """
+    Local prompt-token estimate for streams hung up before the provider's
+    final usage event: ~4 characters per text token plus a per-image cost.
+    The per-image cost is a running average fitted to every call whose
+    usage did arrive, so it tracks the deployed model's image tokenizer.
+    """
+
+    CHARS_PER_TOKEN = 4
+
+    def __init__(self, tokens_per_image: float):
+        self.tokens_per_image = tokens_per_image
+        self.lock = threading.Lock()
+
+    def _measure(self, messages: List[Dict]):
+        chars, images = 0, 0
+        for message in messages:
+            content = message.get("content")
+            parts = content if isinstance(content, list) else [{"type": "text", "text": content or ""}]
+            for part in parts:
+                if part.get("type") == "text":
+                    chars += len(part.get("text", ""))
+                else:
+                    images += 1
+        return chars / self.CHARS_PER_TOKEN, images
+
+    def estimate(self, messages: List[Dict]) -> int:
+        text_tokens, images = self._measure(messages)
+        with self.lock:
+            return round(text_tokens + images * self.tokens_per_image)
+
+    def observe(self, messages: List[Dict], prompt_tokens: int):
+        text_tokens, images = self._measure(messages)
+        if not images or not prompt_tokens:
+            return
+        per_image = max(0.0, (prompt_tokens - text_tokens) / images)
+        with self.lock:
+            self.tokens_per_image = 0.8 * self.tokens_per_image + 0.2 * per_image
+
+
+prompt_estimator = PromptTokenEstimator(PROMPT_TOKENS_PER_IMAGE)
+
+
+class IncrementalJSONScanner:
+    """
+    Tracks the first top-level JSON object in streamed text, one chunk at a
+    time. `complete` flips as soon as its closing brace arrives, and
+    header() returns the top-level scalar members finished so far.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.pos = 0
+        self.start = -1
+        self.end = -1
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.last_member_end = -1
+        self.header_cache = (-1, {})
+
+    @property
+    def complete(self) -> bool:
+        return self.end != -1
+
+    def feed(self, chunk: str) -> bool:
+        self.text += chunk
+        while self.pos < len(self.text) and self.end == -1:
+            ch = self.text[self.pos]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif self.start == -1:
+                # Skip anything before the object (e.g. a ```json fence)
+                if ch == "{":
+                    self.start, self.depth = self.pos, 1
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+            elif ch in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end = self.pos
+            elif ch == "," and self.depth == 1:
+                self.last_member_end = self.pos
+            self.pos += 1
+        return self.complete
+
+    def object_text(self) -> str:
+        return self.text[self.start:self.end + 1] if self.complete else self.text
+
+    def header(self) -> Dict:
+        if self.last_member_end == -1:
+            return {}
+        if self.header_cache[0] != self.last_member_end:
+            try:
+                members = json.loads(self.text[self.start:self.last_member_end] + "}")
+            except ValueError:
+                members = {}
+            header = {k: v for k, v in members.items() if not isinstance(v, (list, dict))}
+            self.header_cache = (self.last_member_end, header)
+        return self.header_cache[1]
+
+
+async def chat_completion_stream(messages: List[Dict], params: Dict, on_partial=None,
+                                 prefix: str = "") -> Dict:
+    """
+    Streams a completion through IncrementalJSONScanner and hangs up as soon
+    as the top-level object closes, so trailing chatter is never generated.
+    Finished header fields are handed to `on_partial` as they arrive.
+    For a continuation the scanner starts from `prefix` and only the new
+    text is returned.
+    """
+    global streams_stopped_early
+    scanner = IncrementalJSONScanner()
+    scanner.feed(prefix)
+    finish_reason, usage, chunks = None, None, 0
+    published, last_publish = 0, 0.0
+
+    async with aclosing(watsonx_client.chat_stream(messages, to_chat_params(params))) as events:
+        async for event in events:
+            usage = event.get("usage") or usage
+            for choice in event.get("choices", []):
+                delta = (choice.get("delta") or {}).get("content") or ""
+                if delta:
+                    chunks += 1
+                    scanner.feed(delta)
+                finish_reason = choice.get("finish_reason") or finish_reason
+
+            if scanner.complete:
+                if finish_reason is None:
+                    streams_stopped_early += 1
+                    finish_reason = "stop"
+                break
+
+            if on_partial and time.monotonic() - last_publish >= PARTIAL_UPDATE_INTERVAL_SEC:
+                header = scanner.header()
+                if len(header) > published:
+                    published, last_publish = len(header), time.monotonic()
+                    await on_partial(header)
+
+    content = scanner.object_text()
+    if prefix:
+        content = scanner.text[len(prefix):scanner.end + 1 if scanner.complete else None]
+
+    return {
+        "choices": [{
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": finish_reason
+        }],
+        # Usage arrives in the last event; when we hang up first, estimate the
+        # prompt locally and count chunks (~1 token each) for the completion
+        "usage": usage or {
+            "prompt_tokens": prompt_estimator.estimate(messages),
+            "completion_tokens": chunks,
+            "estimated": True
+        },
+    }
+
+##########################################
+# TOKEN ACCOUNTING
+##########################################
+usage_lock = threading.Lock()
+usage_totals = defaultdict(lambda: {
+    "calls": 0, "estimated_calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency_ms": 0.0
+})
+
+
+def record_model_call(calls: List[Dict], kind: str, prompt_version: str,
+                      response: Dict, started: float) -> Dict:
+    """
+    Append one call's usage and latency to `calls`. Usage is as reported by
+    the provider unless `estimated` is set (stream hung up before usage came).
+    """
+    usage = response.get("usage") or {}
+    call = {
+        "kind": kind,
+        "prompt_version": prompt_version,
+        "prompt_tokens": usage.get("prompt_tokens", 0),
+        "completion_tokens": usage.get("completion_tokens", 0),
+        "estimated": bool(usage.get("estimated")),
+        "latency_ms": round(1000 * (time.perf_counter() - started), 1),
+    }
+    calls.append(call)
+
+    with usage_lock:
+        totals = usage_totals[f"{prompt_version}/{kind}"]
+        totals["calls"] += 1
+        totals["estimated_calls"] += call["estimated"]
+        totals["prompt_tokens"] += call["prompt_tokens"]
+        totals["completion_tokens"] += call["completion_tokens"]
+        totals["latency_ms"] += call["latency_ms"]
+    return call
+
+
+def persist_inference_usage(job_id: str, filename: str, calls: List[Dict]):
+    if not calls:
+        return
+    rows = [
+        (job_id, filename, c["kind"], c["prompt_version"],
+         c["prompt_tokens"], c["completion_tokens"], c["estimated"], c["latency_ms"])
+        for c in calls
+    ]
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            execute_values(cur, """
+                INSERT INTO inference_usage (
+                    job_id, filename, call_kind, prompt_version,
+                    prompt_tokens, completion_tokens, estimated, latency_ms
+                ) VALUES %s
+            """, rows)
+            cur.close()
+    except Exception as e:
+        logger.warning(f"Could not record token usage for {job_id}/{filename}: {e}")
+
+
+def usage_stats() -> Dict:
+    with usage_lock:
+        return {
+            key: {
+                **totals,
+                "latency_ms": round(totals["latency_ms"], 1),
+                "avg_latency_ms": round(totals["latency_ms"] / totals["calls"], 1)
+            }
+            for key, totals in usage_totals.items()
+        }
+
+##########################################
+# CORE EXTRACTION
+##########################################
+def build_messages(image_bytes: bytes, mime: str, prompt_version: str,
+                   text: str = None) -> List[Dict]:
+    prompt = PROMPT_VERSIONS[prompt_version].strip()
+    if text is not None:
+        # PDF page sent as its text layer instead of an image
+        return [{
+            "role": "user",
+            "content": [{
+                "type": "text",
+                "text": f"{prompt}\n\nThe invoice page is given as text extracted from the PDF "
+                        f"(no image; report stamp and signature fields as not visible):\n\n{text}"
+            }]
+        }]
+
+    img_b64 = base64.b64encode(image_bytes).decode()
     data_url = f"data:{mime};base64,{img_b64}"
 
-    messages = [{
+    return [{
         "role": "user",
         "content": [
             {"type": "image_url", "image_url": {"url": data_url}},
-            {"type": "text", "text": invoice_prompt.strip()}
+            {"type": "text", "text": prompt}
         ]
     }]
 
+
+async def call_model(messages: List[Dict], params: Dict, calls: List[Dict],
+                     kind: str, prompt_version: str, on_partial=None, prefix: str = "") -> Dict:
+    """One logical model call with transport retries; usage lands in `calls`."""
     for attempt in range(3):
         try:
-            response = model.chat(messages=messages, params=generation_params)
-            raw = response["choices"][0]["message"]["content"]
-            return parse_json_robust(raw)
+            started = time.perf_counter()
+            cancelled = []
+            try:
+                response = await hedger.run(messages, params, on_partial, prefix, cancelled)
+            finally:
+                # Losing hedged calls were still billed by the provider
+                for usage in cancelled:
+                    record_model_call(calls, "hedge", prompt_version, {"usage": usage}, started)
+            record_model_call(calls, kind, prompt_version, response, started)
+            return response
+        except CircuitOpenError:
+            raise
         except Exception as e:
             logger.error(f"OCR attempt {attempt+1} failed: {str(e)}")
             if attempt == 2:
                 raise
-            time.sleep(2 ** attempt)
+            await asyncio.sleep(rate_limiter.backoff(attempt, e))
+
+
+def join_continuation(partial: str, tail: str, max_overlap: int = 300) -> str:
+    """Appends a continuation, dropping any text the model repeated from the end of `partial`."""
+    tail = re.sub(r"^```(?:json)?", "", tail.lstrip())
+    for size in range(min(max_overlap, len(partial), len(tail)), 0, -1):
+        if partial.endswith(tail[:size]):
+            return partial + tail[size:]
+    return partial + tail
+
+
+async def continue_output(messages: List[Dict], partial: str, calls: List[Dict],
+                          prompt_version: str) -> str:
+    """Ask the model for only the missing tail of a cut-off answer."""
+    followup = messages + [
+        {"role": "assistant", "content": partial},
+        {"role": "user", "content": [{"type": "text", "text": continuation_prompt}]},
+    ]
+    params = {**generation_params, "max_new_tokens": CONTINUATION_MAX_TOKENS}
+    response = await call_model(followup, params, calls, "recovery", prompt_version, prefix=partial)
+    return response["choices"][0]["message"]["content"]
+
+
+async def extract_invoice_async(image_bytes: bytes, mime: str, prompt_version: str = None,
+                                calls: List[Dict] = None, max_new_tokens: int = None,
+                                on_partial=None, text: str = None) -> Dict:
+    """
+    Extract one invoice. Every model call made is appended to `calls` (when
+    given) with its token usage and latency. With streaming on, `on_partial`
+    receives header fields before the item list is finished. Passing `text`
+    (a PDF text layer) instead of image bytes extracts from the text alone.
+
+    Generation is capped at `max_new_tokens` (default: the global cap).
+    Failures are told apart:
+    - cut off (object never closed): short continuation calls complete the
+      tail (tracked as "recovery"); runaway loops raise TruncatedOutputError
+    - malformed (object closed but invalid): lossless local repair, listed
+      in "outputRepaired", else MalformedOutputError
+    """
+    prompt_version = prompt_version or DEFAULT_PROMPT_VERSION
+    calls = calls if calls is not None else []
+    messages = build_messages(image_bytes, mime, prompt_version, text)
+    wire = prompt_version in WIRE_PROMPT_VERSIONS
+    if wire and on_partial is not None:
+        publish = on_partial
+
+        async def on_partial(header: Dict):
+            await publish(expand_wire_output(header))
+    budget = min(max_new_tokens or MAX_NEW_TOKENS_CAP, MAX_NEW_TOKENS_CAP)
+
+    params = {**generation_params, "max_new_tokens": budget}
+    response = await call_model(messages, params, calls, "main", prompt_version, on_partial)
+    raw = response["choices"][0]["message"]["content"]
+
+    scanner = IncrementalJSONScanner()
+    scanner.feed(raw)
+    if scanner.start == -1:
+        raise MalformedOutputError("Model output contains no JSON object")
+
+    rounds = 0
+    while not scanner.complete:
+        if is_runaway(raw):
+            raise TruncatedOutputError(f"Runaway generation stopped at {budget} tokens")
+        if rounds >= CONTINUATION_ROUNDS:
+            raise TruncatedOutputError(f"Output still incomplete after {rounds} continuation(s)")
+
+        rounds += 1
+        logger.warning(f"Output cut off after {len(raw)} chars, requesting continuation {rounds}")
+        raw = join_continuation(raw, await continue_output(messages, raw, calls, prompt_version))
+        scanner = IncrementalJSONScanner()
+        scanner.feed(raw)
+
+    repairs = []
+    data = parse_json_robust(scanner.object_text(), repairs)
+    if not data:
+        raise MalformedOutputError("Model returned an empty object")
+    if wire:
+        data = expand_wire_output(data)
+    if repairs:
+        # Flag locally repaired output so consumers can review it
+        data["outputRepaired"] = repairs
+    return data
+
+
+def extract_invoice_from_bytes(image_bytes: bytes, mime: str, prompt_version: str = None) -> Dict:
+    """Blocking wrapper for scripts and callers without an event loop."""
+    return asyncio.run(extract_invoice_async(image_bytes, mime, prompt_version))
+
+
+def extract_invoice_from_path(image_path: str) -> Dict:
+    with open(image_path, "rb") as f:
+        content = f.read()
+    if is_pdf(content):
+        return asyncio.run(extract_pdf_invoice(image_path, default_extraction_options()))
+    return extract_invoice_from_bytes(content, guess_image_mime(content))
+
+##########################################
+# MULTI-PAGE PDF INVOICES
+##########################################
+# Totals, stamp and signature sit at the foot of the invoice, i.e. on its last page
+PDF_LAST_PAGE_FIELDS = (
+    "netTotal", "downPayment", "EMIAmount", "stampPresent", "informationInStamp",
+    "signaturePresent", "hypothecationStamp", "stampCompanyMatching_score"
+)
+PDF_EMPTY_VALUES = ("", None, 0, "0", "Absent", "No")
+
+
+def prepare_pdf_page(png: bytes, options: Dict):
+    """CPU stage for one rendered page; returns (payload, mime, max_new_tokens)."""
+    img = decode_image(png)
+    # A render is never the customer's original file, so "none" still gets
+    # the payload downscaling that "original" applies
+    mode = options["preprocess_mode"]
+    payload, mime = prepare_image_payload(png, img, "original" if mode == "none" else mode)
+    return payload, mime, estimate_output_budget(img)
+
+
+def text_output_budget(text: str) -> int:
+    """estimate_output_budget for a page sent as text: one line per text line."""
+    if not OUTPUT_BUDGET_ADAPTIVE:
+        return MAX_NEW_TOKENS_CAP
+    budget = OUTPUT_BUDGET_BASE + OUTPUT_BUDGET_PER_LINE * (text.count("\n") + 1)
+    return max(OUTPUT_BUDGET_MIN, min(MAX_NEW_TOKENS_CAP, budget))
+
+
+def merge_page_results(pages: List[Dict]) -> Dict:
+    """
+    One invoice from per-page extractions: item tables are concatenated in
+    page order; each header field comes from the first page that has it,
+    except PDF_LAST_PAGE_FIELDS, which come from the last.
+    """
+    merged = {}
+    for page in pages:
+        for key in page:
+            if key in ("items", "outputRepaired") or key in merged:
+                continue
+            found = [p[key] for p in pages if p.get(key) not in PDF_EMPTY_VALUES]
+            if not found:
+                merged[key] = page[key]
+            else:
+                merged[key] = found[-1] if key in PDF_LAST_PAGE_FIELDS else found[0]
+    merged["items"] = [item for page in pages for item in page.get("items") or []]
+    repairs = [
+        f"page {number}: {repair}"
+        for number, page in enumerate(pages, start=1)
+        for repair in page.get("outputRepaired") or []
+    ]
+    if repairs:
+        merged["outputRepaired"] = repairs
+    return merged
+
+
+async def extract_pdf_invoice(pdf_path: str, options: Dict, calls: List[Dict] = None,
+                              on_partial=None) -> Dict:
+    """
+    Extract a (multi-page) PDF invoice. Pages are rendered in the PDF
+    process pool and extracted concurrently, then merged into one result.
+    Header fields stream from the first page only.
+
+    With PDF_TEXT_LAYER=prefer, pages carrying at least PDF_TEXT_MIN_CHARS of
+    embedded text are extracted from that text and never rendered.
+    """
+    calls = calls if calls is not None else []
+    texts = await pdf_renderer.read_text(pdf_path)
+    if not texts:
+        raise ValueError("PDF has no pages")
+    if len(texts) > PDF_MAX_PAGES:
+        raise ValueError(f"PDF has {len(texts)} pages, the limit is {PDF_MAX_PAGES}")
+
+    async def extract_page(page_number: int):
+        text = texts[page_number]
+        publish = on_partial if page_number == 0 else None
+        if PDF_TEXT_LAYER == "prefer" and len(text) >= PDF_TEXT_MIN_CHARS:
+            data = await extract_invoice_async(
+                None, None, options["prompt_version"], calls, text_output_budget(text),
+                publish, text=text
+            )
+            return data, "text"
+
+        png = await pdf_renderer.render(pdf_path, page_number)
+        payload, mime, max_new_tokens = await worker_pool.run_blocking(prepare_pdf_page, png, options)
+        del png
+        data = await extract_invoice_async(
+            payload, mime, options["prompt_version"], calls, max_new_tokens, publish
+        )
+        return data, "image"
+
+    # 📄 All pages in flight at once; the render pool and the inference
+    # concurrency limit bound the actual parallelism. The first failing page
+    # fails the document, so the others are cancelled rather than left to
+    # spend renders and model calls on a result nobody will read.
+    tasks = [asyncio.create_task(extract_page(n)) for n in range(len(texts))]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+    failed = [task.exception() for task in tasks if not task.cancelled() and task.exception()]
+    if failed:
+        raise failed[0]
+    results = [task.result() for task in tasks]
+
+    merged = merge_page_results([data for data, _ in results])
+    merged["pdfPages"] = [
+        {
+            "page": n + 1,
+            "source": source,
+            "items": len(data.get("items") or []),
+            **({"text": texts[n]} if PDF_TEXT_LAYER != "off" else {})
+        }
+        for n, (data, source) in enumerate(results)
+    ]
+    logger.info(
+        f"PDF {os.path.basename(pdf_path)}: {len(texts)} page(s), "
+        f"{sum(source == 'text' for _, source in results)} from the text layer, "
+        f"{len(merged['items'])} item(s)"
+    )
+    return merged
 
 ##########################################
 # API ENDPOINT
@@ -764,7 +3537,10 @@ def extract_invoice_from_path(image_path: str) -> Dict:
 async def extract_invoice_api(
     request: Request,
     files: List[UploadFile] = File(...),
-    x_api_key: str = Header(None)
+    x_api_key: str = Header(None),
+    x_preprocess_mode: str = Header(None),
+    x_prompt_version: str = Header(None),
+    x_callback_url: str = Header(None)
 ):
     job_id = request.state.job_id
     client_ip = request.client.host if request.client else "unknown"
@@ -772,38 +3548,102 @@ async def extract_invoice_api(
     if not x_api_key or x_api_key not in VALID_API_KEYS:
         raise HTTPException(status_code=401, detail="Invalid API key")
 
-    api_client_name = VALID_API_KEYS[x_api_key]
+    if x_callback_url:
+        await check_job_callback(x_api_key, x_callback_url)
+
+    options = {
+        "preprocess_mode": resolve_preprocess_mode(x_api_key, x_preprocess_mode),
+        "prompt_version": resolve_prompt_version(x_api_key, x_prompt_version),
+    }
     response_payload = []
 
-    for file in files:
-        # 1️⃣ Insert row immediately with empty data + Processing
-        insert_document_data(
-            job_id=job_id,
-            filename=file.filename,
-            extracted_data={},  # empty initially
-            api_key=x_api_key
+    # 🚦 Admission control: the whole batch must fit in the worker backlog (or queue)
+    durable = JOB_QUEUE_BACKEND == "postgres"
+    capacity = QUEUE_MAX_DEPTH if durable else worker_pool.capacity
+    if len(files) > capacity:
+        # Could never be admitted, so retrying is pointless: ask for a smaller batch
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch of {len(files)} files exceeds the limit of {capacity} per request"
+        )
+    reserved = 0 if durable else len(files)
+    if durable:
+        admitted = await worker_pool.run_blocking(queue_has_room, len(files))
+    else:
+        admitted = worker_pool.try_reserve(len(files))
+    if not admitted:
+        logger.warning(f"Job {job_id} rejected: worker pool full ({len(files)} files)")
+        raise HTTPException(
+            status_code=429,
+            detail="Server busy, please retry later",
+            headers={"Retry-After": str(WORKER_RETRY_AFTER_SEC)}
         )
 
-        # 2️⃣ Save file temporarily
-        tmp_file = tempfile.NamedTemporaryFile(
-            delete=False,
-            suffix=os.path.splitext(file.filename)[1]
+    uploads = []
+    dispatched = 0
+    try:
+        # 1️⃣ Stream files to the spool dir and look each one up in the extraction cache
+        request_budget = UPLOAD_MAX_REQUEST_BYTES
+        for file in files:
+            spool_path, sha256_hex, size = await spool_upload(file, request_budget)
+            request_budget -= size
+            cache_key = extraction_cache_key(sha256_hex, options)
+            uploads.append({
+                "filename": file.filename,
+                "spool_path": spool_path,
+                "cache_key": cache_key,
+                "cached": await worker_pool.run_blocking(extraction_cache.get, cache_key),
+                "dispatched": False
+            })
+
+        # 2️⃣ Register all rows (empty data + Processing) in one transaction,
+        #    queueing cache misses in the same transaction when the queue is durable
+        misses = [upload for upload in uploads if upload["cached"] is None]
+        # DB calls go through the thread executor: a slow pool checkout must
+        # not stall the model calls awaiting on this event loop
+        await worker_pool.run_blocking(
+            register_job_documents,
+            job_id,
+            [upload["filename"] for upload in uploads],
+            x_api_key,
+            [{**upload, "options": options} for upload in misses] if durable else None,
+            x_callback_url
         )
-        tmp_file.write(await file.read())
-        tmp_file.close()
-
-        # 3️⃣ Start background thread for extraction
-        threading.Thread(
-            target=background_invoice_processing,
-            args=(job_id, file.filename, tmp_file.name, x_api_key),
-            daemon=True
-        ).start()
-
-        # 4️⃣ Add file info to response
-        response_payload.append({
-            "filename": file.filename,
-            "status": "Processing"
-        })
+
+        for upload in uploads:
+            if upload["cached"] is not None:
+                # ♻️ Cache hit: complete immediately, no model call
+                await worker_pool.run_blocking(
+                    complete_document,
+                    job_id, upload["filename"], upload["cached"], x_api_key, client_ip
+                )
+                status = "Success"
+            elif durable:
+                # 3️⃣ Already queued; a worker process picks it up
+                upload["dispatched"] = True
+                status = "Processing"
+            else:
+                # 3️⃣ Hand off to the worker pool for extraction
+                worker_pool.submit(
+                    background_invoice_processing,
+                    job_id, upload["filename"], upload["spool_path"], x_api_key,
+                    upload["cache_key"], options
+                )
+                upload["dispatched"] = True
+                dispatched += 1
+                status = "Processing"
+
+            # 4️⃣ Add file info to response
+            response_payload.append({
+                "filename": upload["filename"],
+                "status": status
+            })
+    finally:
+        # Give back slots (and spool files) for files that never made it to the pool
+        worker_pool.release(reserved - dispatched)
+        for upload in uploads:
+            if not upload["dispatched"]:
+                discard_spool_file(upload["spool_path"])
 
     # 5️⃣ Immediate return with Job ID
     return {
@@ -811,14 +3651,321 @@ async def extract_invoice_api(
         "status": "Processing",
     }
 
+##########################################
+# ARCHIVE INGESTION (ZIP)
+##########################################
+ARCHIVE_MAX_BYTES = int(os.getenv("ARCHIVE_MAX_BYTES", 1024 * 1024 * 1024))
+ARCHIVE_MAX_UNCOMPRESSED_BYTES = int(os.getenv("ARCHIVE_MAX_UNCOMPRESSED_BYTES", 4 * 1024 * 1024 * 1024))
+ARCHIVE_MAX_ENTRIES = int(os.getenv("ARCHIVE_MAX_ENTRIES", 2000))
+# Entries unpacked and in the pipeline at once, per archive
+ARCHIVE_PARALLELISM = int(os.getenv("ARCHIVE_PARALLELISM", 8))
+ARCHIVE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".pdf")
+
+archive_feeds = set()
+
+
+def list_archive_entries(archive_path: str) -> List[str]:
+    """Invoice entries of a ZIP, read from its central directory only (nothing is unpacked)."""
+    with zipfile.ZipFile(archive_path) as archive:
+        entries = [
+            info for info in archive.infolist()
+            if not info.is_dir()
+            and not info.filename.startswith("__MACOSX/")
+            and not os.path.basename(info.filename).startswith(".")
+            and info.filename.lower().endswith(ARCHIVE_EXTENSIONS)
+        ]
+    if len(entries) > ARCHIVE_MAX_ENTRIES:
+        raise HTTPException(status_code=413, detail=f"Archive has more than {ARCHIVE_MAX_ENTRIES} invoices")
+    if sum(info.file_size for info in entries) > ARCHIVE_MAX_UNCOMPRESSED_BYTES:
+        raise HTTPException(status_code=413, detail=f"Archive unpacks to more than {ARCHIVE_MAX_UNCOMPRESSED_BYTES} bytes")
+    oversized = [info.filename for info in entries if info.file_size > UPLOAD_MAX_FILE_BYTES]
+    if oversized:
+        raise HTTPException(status_code=413, detail=f"{oversized[0]} exceeds {UPLOAD_MAX_FILE_BYTES} bytes")
+    return [info.filename for info in entries]
+
+
+def spool_archive_entry(archive: zipfile.ZipFile, name: str):
+    """Streams one entry to SPOOL_DIR like spool_upload; returns (spool_path, sha256_hex)."""
+    sha = hashlib.sha256()
+    size = 0
+    spool_file = tempfile.NamedTemporaryFile(dir=SPOOL_DIR, delete=False, suffix=os.path.splitext(name)[1])
+    try:
+        with archive.open(name) as entry:
+            while chunk := entry.read(UPLOAD_CHUNK_BYTES):
+                # The central directory can lie about sizes; enforce while reading
+                size += len(chunk)
+                if size > UPLOAD_MAX_FILE_BYTES:
+                    raise ValueError(f"{name} exceeds {UPLOAD_MAX_FILE_BYTES} bytes")
+                sha.update(chunk)
+                spool_file.write(chunk)
+        spool_file.close()
+    except Exception:
+        spool_file.close()
+        discard_spool_file(spool_file.name)
+        raise
+    return spool_file.name, sha.hexdigest()
+
+
+def spool_archive(archive_path: str, names: List[str], options: Dict) -> List[Dict]:
+    """
+    Unpacks every entry up front and looks each one up in the extraction
+    cache; used when entries go to the durable queue. An entry that cannot
+    be unpacked carries an `error` instead of a spool file.
+    """
+    entries = []
+    try:
+        with zipfile.ZipFile(archive_path) as archive:
+            for name in names:
+                try:
+                    spool_path, sha256_hex = spool_archive_entry(archive, name)
+                except Exception as e:
+                    entries.append({"filename": name, "spool_path": None, "error": str(e)})
+                    continue
+                cache_key = extraction_cache_key(sha256_hex, options)
+                entries.append({
+                    "filename": name,
+                    "spool_path": spool_path,
+                    "cache_key": cache_key,
+                    "cached": extraction_cache.get(cache_key),
+                    "error": None,
+                })
+    except Exception:
+        for entry in entries:
+            discard_spool_file(entry["spool_path"])
+        raise
+    return entries
+
+
+def fail_archive_entries(job_id: str, names: List[str], x_api_key: str):
+    """Best effort: a row that cannot be failed now is logged, not raised."""
+    for name in names:
+        try:
+            fail_document(job_id, name, x_api_key)
+        except Exception as e:
+            logger.error(f"Could not fail archive entry {job_id}/{name}: {e}")
+
+
+async def feed_archive(job_id: str, archive_path: str, names: List[str], x_api_key: str,
+                       options: Dict, reserved: int):
+    """
+    In-memory mode: unpacks entries one at a time and hands each to the
+    worker pool, so archives share WORKER_POOL_SIZE with /extract-invoice
+    and show up in its metrics. The request reserved `reserved` pool slots;
+    further entries wait for a slot, with at most ARCHIVE_PARALLELISM of
+    this archive's entries in the pool at once. Whatever stops the feed,
+    entries it never dispatched are failed rather than left Processing.
+    """
+    gate = asyncio.Semaphore(ARCHIVE_PARALLELISM)
+    handled = set()
+
+    async def run_entry(name, spool_path, cache_key):
+        try:
+            await background_invoice_processing(job_id, name, spool_path, x_api_key, cache_key, options)
+        finally:
+            gate.release()
+
+    archive, spool_path = None, None
+    try:
+        archive = await worker_pool.run_blocking(zipfile.ZipFile, archive_path)
+        for name in names:
+            await gate.acquire()
+            if not reserved:
+                await worker_pool.reserve()
+                reserved += 1
+            try:
+                spool_path, sha256_hex = await worker_pool.run_blocking(spool_archive_entry, archive, name)
+                cache_key = extraction_cache_key(sha256_hex, options)
+                cached = await worker_pool.run_blocking(extraction_cache.get, cache_key)
+                if cached is None:
+                    # 🧵 Consumes the reservation; the task gives the gate back
+                    worker_pool.submit(run_entry, name, spool_path, cache_key)
+                    reserved -= 1
+                    spool_path = None
+                    handled.add(name)
+                    continue
+                # ♻️ Cache hit: complete immediately, no model call
+                await worker_pool.run_blocking(complete_document, job_id, name, cached, x_api_key)
+                handled.add(name)
+            except Exception as e:
+                logger.error(f"Archive entry {job_id}/{name} failed: {e}")
+            discard_spool_file(spool_path)
+            spool_path = None
+            worker_pool.release(1)
+            reserved -= 1
+            gate.release()
+    except Exception as e:
+        logger.error(f"Archive feed {job_id} stopped: {e}")
+    finally:
+        worker_pool.release(reserved)
+        discard_spool_file(spool_path)
+        if archive is not None:
+            archive.close()
+        discard_spool_file(archive_path)
+        leftover = [name for name in names if name not in handled]
+        if leftover:
+            await asyncio.shield(worker_pool.run_blocking(fail_archive_entries, job_id, leftover, x_api_key))
+        logger.info(f"Archive job {job_id}: {len(handled)} of {len(names)} entries dispatched")
+
+
+@app.post("/extract-archive")
+async def extract_archive_api(
+    request: Request,
+    file: UploadFile = File(...),
+    x_api_key: str = Header(None),
+    x_preprocess_mode: str = Header(None),
+    x_prompt_version: str = Header(None),
+    x_callback_url: str = Header(None)
+):
+    """
+    Month-end backlogs: one ZIP of invoice images or PDFs becomes one job
+    with a row per entry. Poll /check-job, stream /job-events or use a
+    webhook for progress, exactly as for /extract-invoice.
+    """
+    job_id = request.state.job_id
+
+    if not x_api_key or x_api_key not in VALID_API_KEYS:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+    if x_callback_url:
+        await check_job_callback(x_api_key, x_callback_url)
+
+    options = {
+        "preprocess_mode": resolve_preprocess_mode(x_api_key, x_preprocess_mode),
+        "prompt_version": resolve_prompt_version(x_api_key, x_prompt_version),
+    }
+    durable = JOB_QUEUE_BACKEND == "postgres"
+
+    # 1️⃣ Stream the archive to the spool dir and read its directory
+    archive_path, _, _ = await spool_upload(file, ARCHIVE_MAX_BYTES, max_file_bytes=ARCHIVE_MAX_BYTES)
+    reserved, entries = 0, []
+    try:
+        try:
+            names = await worker_pool.run_blocking(list_archive_entries, archive_path)
+        except zipfile.BadZipFile:
+            raise HTTPException(status_code=400, detail="Not a valid ZIP archive")
+        if not names:
+            raise HTTPException(status_code=400, detail="Archive contains no invoice images or PDFs")
+
+        # 🚦 Admission control: room in the queue for every entry, or in the
+        #    worker pool for the archive's first ARCHIVE_PARALLELISM entries
+        if durable:
+            if len(names) > QUEUE_MAX_DEPTH:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Archive of {len(names)} invoices exceeds the limit of {QUEUE_MAX_DEPTH}"
+                )
+            admitted = await worker_pool.run_blocking(queue_has_room, len(names))
+        else:
+            reserved = min(len(names), ARCHIVE_PARALLELISM)
+            admitted = worker_pool.try_reserve(reserved)
+            if not admitted:
+                reserved = 0
+        if not admitted:
+            raise HTTPException(
+                status_code=429,
+                detail="Server busy, please retry later",
+                headers={"Retry-After": str(WORKER_RETRY_AFTER_SEC)}
+            )
+
+        if durable:
+            # 2️⃣ Unpack everything now and register the rows together with
+            #    their queue entries, so nothing depends on this process surviving
+            entries = await worker_pool.run_blocking(spool_archive, archive_path, names, options)
+            misses = [e for e in entries if e["error"] is None and e["cached"] is None]
+            await worker_pool.run_blocking(
+                register_job_documents, job_id, names, x_api_key,
+                [{**entry, "options": options} for entry in misses], x_callback_url
+            )
+            for entry in misses:
+                entry["spool_path"] = None  # owned by the queue now
+        else:
+            # 2️⃣ Register every entry (empty data + Processing) in one batched insert
+            await worker_pool.run_blocking(
+                register_job_documents, job_id, names, x_api_key, None, x_callback_url
+            )
+    except Exception:
+        worker_pool.release(reserved)
+        discard_spool_file(archive_path)
+        for entry in entries:
+            discard_spool_file(entry["spool_path"])
+        raise
+
+    if durable:
+        # 3️⃣ Cache hits complete now, unreadable entries fail; workers take the rest
+        discard_spool_file(archive_path)
+        try:
+            for entry in entries:
+                if entry["error"] is not None:
+                    logger.error(f"Archive entry {job_id}/{entry['filename']} failed: {entry['error']}")
+                    await worker_pool.run_blocking(fail_document, job_id, entry["filename"], x_api_key)
+                elif entry["cached"] is not None:
+                    await worker_pool.run_blocking(
+                        complete_document, job_id, entry["filename"], entry["cached"], x_api_key
+                    )
+        finally:
+            for entry in entries:
+                discard_spool_file(entry["spool_path"])
+    else:
+        # 3️⃣ Unpack and extract in the background through the worker pool
+        feed = asyncio.create_task(
+            feed_archive(job_id, archive_path, names, x_api_key, options, reserved)
+        )
+        archive_feeds.add(feed)
+        feed.add_done_callback(archive_feeds.discard)
+
+    logger.info(f"Archive job {job_id}: {len(names)} invoice(s) from {file.filename}")
+    return {
+        "job_id": job_id,
+        "status": "Processing",
+        "count": len(names),
+    }
+
 ##########################################
 # NEW: CHECK JOB STATUS ENDPOINT
 ##########################################
+CHECK_JOB_PAGE_SIZE = int(os.getenv("CHECK_JOB_PAGE_SIZE", 500))
+
+
+def job_status_summary(job_id: str) -> Dict:
+    """Per-status counts plus a version that changes with every write to the job's rows."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT status, count(*), COALESCE(sum(version), 0)
+            FROM document_data
+            WHERE job_id = %s
+            GROUP BY status
+        """, (job_id,))
+        rows = cur.fetchall()
+        cur.close()
+    return {
+        "counts": {status: count for status, count, _ in rows},
+        "version": sum(int(version) for _, _, version in rows),
+    }
+
+
+def overall_job_status(counts: Dict) -> str:
+    if counts and set(counts) == {"Success"}:
+        return "success"
+    if counts.get("Fail"):
+        return "fail"
+    return "processing"
+
+
 @app.get("/check-job/{job_id}")
 def check_job_status(
     job_id: str,
-    x_api_key: str = Header(None)
+    view: str = "full",
+    limit: int = CHECK_JOB_PAGE_SIZE,
+    offset: int = 0,
+    x_api_key: str = Header(None),
+    if_none_match: str = Header(None)
 ):
+    """
+    view=status returns only per-status counts; view=full (default) adds the
+    results, `limit` rows from `offset` (nextOffset is set while more remain).
+    The ETag changes whenever any row of the job changes, so a poll sending
+    it back in If-None-Match gets 304 with no body until something happens.
+    """
     # 🔐 API key validation
     if not x_api_key:
         return {
@@ -830,43 +3977,604 @@ def check_job_status(
             "error": "Invalid API key"
         }
 
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    if view not in ("full", "status"):
+        raise HTTPException(status_code=400, detail="view must be 'full' or 'status'")
+    limit = max(1, min(limit, CHECK_JOB_PAGE_SIZE))
+    offset = max(0, offset)
 
-    cur.execute("""
-        SELECT filename, status, extracted_data
-        FROM document_data
-        WHERE job_id = %s
-    """, (job_id,))
+    # 1️⃣ One aggregate over the job_id index: counts and change version
+    summary = job_status_summary(job_id)
+    counts = summary["counts"]
+    total = sum(counts.values())
 
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-
-    if not rows:
+    if not total:
         return {
             "jobId": job_id,
             "status": "not_found",
             "results": []
         }
 
-    results = []
-    for row in rows:
-        results.append({
-            "filename": row["filename"],
-            "status": row["status"],
-            "data": row["extracted_data"] or {}
-        })
+    etag = f'"{job_id}-{total}-{summary["version"]}-{view}-{offset}-{limit}"'
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    body = {
+        "jobId": job_id,
+        "status": overall_job_status(counts),
+        "count": total,
+        "counts": counts,
+    }
+
+    # 2️⃣ Full view: one page of rows with their extracted data
+    if view == "full":
+        with db_connection() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute("""
+                SELECT filename, status, extracted_data
+                FROM document_data
+                WHERE job_id = %s
+                ORDER BY filename
+                LIMIT %s OFFSET %s
+            """, (job_id, limit, offset))
+            rows = cur.fetchall()
+            cur.close()
+
+        body["results"] = [
+            {
+                "filename": row["filename"],
+                "status": row["status"],
+                "data": row["extracted_data"] or {}
+            }
+            for row in rows
+        ]
+        body["nextOffset"] = offset + len(rows) if offset + len(rows) < total else None
+
+    return JSONResponse(body, headers={"ETag": etag})
+
+##########################################
+# PUSHED JOB STATUS (LISTEN/NOTIFY + SSE)
+##########################################
+JOB_EVENTS_HEARTBEAT_SEC = float(os.getenv("JOB_EVENTS_HEARTBEAT_SEC", 15))
+TERMINAL_STATUSES = ("Success", "Fail")
+
+
+class JobStatusListener:
+    """
+    One LISTEN connection per API process, outside the pool, on its own
+    thread. Notifications are handed to the asyncio queues of the SSE streams
+    watching that job. After a reconnect every stream gets a resync marker,
+    since notifications sent while disconnected are lost.
+    """
+
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.lock = threading.Lock()
+        self.subscribers = defaultdict(set)  # job_id -> {(loop, queue)}
+        self.thread = None
+        self.connected = False
+        self.received = 0
+
+    def subscribe(self, job_id: str):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="job-status-listener", daemon=True)
+                self.thread.start()
+            entry = (asyncio.get_running_loop(), asyncio.Queue())
+            self.subscribers[job_id].add(entry)
+        return entry
+
+    def unsubscribe(self, job_id: str, entry):
+        with self.lock:
+            self.subscribers[job_id].discard(entry)
+            if not self.subscribers[job_id]:
+                del self.subscribers[job_id]
+
+    def _deliver(self, job_id: str, event: Dict):
+        with self.lock:
+            targets = list(self.subscribers.get(job_id, ())) if job_id else [
+                entry for entries in self.subscribers.values() for entry in entries
+            ]
+        for loop, queue in targets:
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    def _run(self):
+        first = True
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**DB_CONFIG)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(f"LISTEN {self.channel}")
+                self.connected = True
+                if not first:
+                    self._deliver(None, {"resync": True})
+                first = False
+                while True:
+                    if select.select([conn], [], [], 5.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self.received += 1
+                        try:
+                            event = json.loads(notify.payload)
+                        except ValueError:
+                            continue
+                        self._deliver(event.get("job_id"), event)
+            except Exception as e:
+                logger.error(f"Job status listener disconnected: {e}")
+            finally:
+                self.connected = False
+                if conn is not None and not conn.closed:
+                    conn.close()
+            time.sleep(2)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "connected": self.connected,
+                "jobs_watched": len(self.subscribers),
+                "streams": sum(len(entries) for entries in self.subscribers.values()),
+                "notifications": self.received,
+            }
+
+
+job_status_listener = JobStatusListener(JOB_STATUS_CHANNEL)
+
+
+def fetch_job_files(job_id: str, filename: str = None) -> List[Dict]:
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        if filename is None:
+            cur.execute("""
+                SELECT filename, status, extracted_data
+                FROM document_data
+                WHERE job_id = %s
+            """, (job_id,))
+        else:
+            cur.execute("""
+                SELECT filename, status, extracted_data
+                FROM document_data
+                WHERE job_id = %s AND filename = %s
+            """, (job_id, filename))
+        rows = cur.fetchall()
+        cur.close()
+    return rows
+
 
-    overall_status = "processing"
-    if all(r["status"] == "Success" for r in results):
-        overall_status = "success"
-    elif any(r["status"] == "Fail" for r in results):
-        overall_status = "fail"
+def sse_event(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
+
+@app.get("/job-events/{job_id}")
+async def job_events(job_id: str, x_api_key: str = Header(None)):
+    """
+    Server-Sent Events alternative to polling /check-job: one `file` event
+    per status change (same shape as a /check-job result entry), then a
+    `complete` event with the overall status once every file is done.
+    """
+    if not x_api_key or x_api_key not in VALID_API_KEYS:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+
+    # Subscribe before the snapshot so no change can slip in between
+    entry = job_status_listener.subscribe(job_id)
+    try:
+        rows = await worker_pool.run_blocking(fetch_job_files, job_id)
+    except Exception:
+        job_status_listener.unsubscribe(job_id, entry)
+        raise
+    if not rows:
+        job_status_listener.unsubscribe(job_id, entry)
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def stream(rows):
+        queue = entry[1]
+        statuses = {}
+        try:
+            while True:
+                for row in rows:
+                    statuses[row["filename"]] = row["status"]
+                    yield sse_event("file", {
+                        "filename": row["filename"],
+                        "status": row["status"],
+                        "data": row["extracted_data"] or {}
+                    })
+                if all(status in TERMINAL_STATUSES for status in statuses.values()):
+                    overall = "fail" if "Fail" in statuses.values() else "success"
+                    yield sse_event("complete", {"jobId": job_id, "status": overall})
+                    return
+
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=JOB_EVENTS_HEARTBEAT_SEC)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    rows = []
+                    continue
+                # One query per change: the file that changed, or all of them after a resync
+                filename = None if event.get("resync") else event["filename"]
+                rows = await worker_pool.run_blocking(fetch_job_files, job_id, filename)
+        finally:
+            job_status_listener.unsubscribe(job_id, entry)
+
+    return StreamingResponse(
+        stream(rows),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+##########################################
+# WEBHOOK CALLBACKS (SIGNED, RETRIED)
+##########################################
+WEBHOOKS_ENABLED = os.getenv("WEBHOOKS_ENABLED", "true").lower() == "true"
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 4))
+WEBHOOK_TIMEOUT_SEC = float(os.getenv("WEBHOOK_TIMEOUT_SEC", 10))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", 8))
+WEBHOOK_RETRY_BASE_SEC = float(os.getenv("WEBHOOK_RETRY_BASE_SEC", 5))
+WEBHOOK_RETRY_MAX_SEC = float(os.getenv("WEBHOOK_RETRY_MAX_SEC", 3600))
+WEBHOOK_POLL_SEC = float(os.getenv("WEBHOOK_POLL_SEC", 5))
+# Signs callbacks for API keys that have no registered endpoint (per-job URLs only);
+# without it, per-job URLs need the key to register one with PUT /webhook first
+WEBHOOK_SIGNING_SECRET = os.getenv("WEBHOOK_SIGNING_SECRET", "")
+# Only for local testing (e.g. webhook_sink.py on 127.0.0.1)
+WEBHOOK_ALLOW_PRIVATE_TARGETS = os.getenv("WEBHOOK_ALLOW_PRIVATE_TARGETS", "false").lower() == "true"
+
+
+def is_public_address(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    # Excludes loopback, private, link-local (cloud metadata), CGNAT and reserved ranges
+    return ip.is_global and not ip.is_multicast
+
+
+def resolve_public(host: str, port: int) -> List[str]:
+    """The host's addresses, or [] if it does not resolve or any of them is not public."""
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError):
+        return []
+    addresses = list(dict.fromkeys(info[4][0] for info in infos))
+    if WEBHOOK_ALLOW_PRIVATE_TARGETS or all(is_public_address(a) for a in addresses):
+        return addresses
+    return []
+
+
+def valid_callback_url(url: str) -> bool:
+    """
+    An http(s) URL whose host resolves only to public addresses. Blocking
+    (DNS lookup); checked on registration. Deliveries connect through
+    PublicOnlyBackend, which checks the addresses it actually connects to.
+    """
+    try:
+        parts = urlsplit(url or "")
+        host, port = parts.hostname, parts.port
+    except ValueError:
+        return False
+    if parts.scheme not in ("http", "https") or not host:
+        return False
+    if WEBHOOK_ALLOW_PRIVATE_TARGETS:
+        return True
+    return bool(resolve_public(host, port or (443 if parts.scheme == "https" else 80)))
+
+
+class PublicOnlyBackend(httpcore.SyncBackend):
+    """
+    Resolves the callback host once and connects to one of the validated
+    addresses, so a name re-pointed between the check and the connect
+    (DNS rebinding) cannot reach an internal address. The URL is unchanged,
+    so the Host header and TLS SNI/certificate check still use the hostname.
+    """
+
+    def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        addresses = resolve_public(host, port)
+        if not addresses:
+            raise httpcore.ConnectError("Callback URL does not resolve to a public address")
+        for i, address in enumerate(addresses):
+            try:
+                return super().connect_tcp(address, port, timeout, local_address, socket_options)
+            except httpcore.ConnectError:
+                if i == len(addresses) - 1:
+                    raise
+
+
+def webhook_transport() -> httpx.HTTPTransport:
+    transport = httpx.HTTPTransport()
+    # httpx has no public hook for the network backend; connections are created
+    # lazily by the pool, so swapping it before the first request covers all of them
+    transport._pool._network_backend = PublicOnlyBackend()
+    return transport
+
+
+def signing_secret_for(api_key: str) -> str:
+    """The key's registered webhook secret, else WEBHOOK_SIGNING_SECRET ("" if neither)."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT secret FROM webhook_endpoints WHERE api_key = %s", (api_key,))
+        row = cur.fetchone()
+        cur.close()
+    return row[0] if row else WEBHOOK_SIGNING_SECRET
+
+
+async def check_job_callback(api_key: str, url: str):
+    """400 unless a per-job X-Callback-Url is a public http(s) URL we can sign for."""
+    if not await worker_pool.run_blocking(valid_callback_url, url):
+        raise HTTPException(
+            status_code=400,
+            detail="X-Callback-Url must be an http(s) URL on a public address"
+        )
+    if WEBHOOKS_ENABLED and not await worker_pool.run_blocking(signing_secret_for, api_key):
+        raise HTTPException(
+            status_code=400,
+            detail="Register a webhook with PUT /webhook first to get a signing secret"
+        )
+
+
+def register_job_webhook(cur, job_id: str, api_key: str, callback_url: str = None):
+    """Park a delivery for the job: the per-job URL if given, else the key's registered one."""
+    cur.execute("""
+        INSERT INTO webhook_deliveries (job_id, api_key, url)
+        SELECT %s, %s, url FROM (
+            SELECT COALESCE(%s, (SELECT url FROM webhook_endpoints WHERE api_key = %s)) AS url
+        ) target
+        WHERE url IS NOT NULL
+    """, (job_id, api_key, callback_url, api_key))
+
+
+def maybe_queue_webhook(job_id: str):
+    """
+    Called after a file reaches Success/Fail (after its commit). Releases the
+    job's delivery once no file is left Processing; the status check makes
+    exactly one of several concurrently finishing files release it.
+    """
+    if not WEBHOOKS_ENABLED:
+        return
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE webhook_deliveries
+                SET status = 'queued', next_attempt_at = now()
+                WHERE job_id = %s AND status = 'waiting'
+                  AND NOT EXISTS (
+                      SELECT 1 FROM document_data
+                      WHERE job_id = %s AND status NOT IN ('Success', 'Fail')
+                  )
+            """, (job_id, job_id))
+            queued = cur.rowcount
+            cur.close()
+        if queued:
+            webhook_dispatcher.poke()
+    except Exception as e:
+        logger.error(f"Could not queue webhook for {job_id}: {e}")
+
+
+def claim_webhook_deliveries(limit: int) -> List[Dict]:
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            WITH due AS (
+                SELECT id FROM webhook_deliveries
+                WHERE (status = 'queued' AND next_attempt_at <= now())
+                   OR (status = 'delivering' AND lease_expires_at < now())
+                ORDER BY next_attempt_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE webhook_deliveries d
+            SET status = 'delivering', attempts = d.attempts + 1,
+                lease_expires_at = now() + make_interval(secs => %s)
+            FROM due
+            WHERE d.id = due.id
+            RETURNING d.*, (SELECT secret FROM webhook_endpoints e WHERE e.api_key = d.api_key) AS secret
+        """, (limit, 2 * WEBHOOK_TIMEOUT_SEC + 30))
+        rows = cur.fetchall()
+        cur.close()
+    return rows
+
+
+def record_webhook_attempt(delivery: Dict, response_status: int = None, error: str = None):
+    delivered = error is None
+    if delivered:
+        status, delay = "delivered", 0
+    elif delivery["attempts"] >= WEBHOOK_MAX_ATTEMPTS:
+        status, delay = "dead", 0
+    else:
+        status = "queued"
+        delay = min(WEBHOOK_RETRY_MAX_SEC, WEBHOOK_RETRY_BASE_SEC * 2 ** (delivery["attempts"] - 1))
+        delay = random.uniform(delay / 2, delay)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE webhook_deliveries
+            SET status = %s, response_status = %s, last_error = %s, lease_expires_at = NULL,
+                next_attempt_at = now() + make_interval(secs => %s),
+                delivered_at = CASE WHEN %s THEN now() END
+            WHERE id = %s
+        """, (status, response_status, error, delay, delivered, delivery["id"]))
+        cur.close()
+    return status
+
+
+def job_result_payload(job_id: str) -> Dict:
+    """Same body /check-job returns for the job."""
+    rows = fetch_job_files(job_id)
+    results = [
+        {"filename": row["filename"], "status": row["status"], "data": row["extracted_data"] or {}}
+        for row in rows
+    ]
+    counts = defaultdict(int)
+    for r in results:
+        counts[r["status"]] += 1
     return {
         "jobId": job_id,
-        "status": overall_status,
+        "status": overall_job_status(counts),
         "count": len(results),
+        "counts": dict(counts),
         "results": results
     }
+
+
+def sign_webhook(secret: str, timestamp: str, body: bytes) -> str:
+    digest = hmac.new(secret.encode(), timestamp.encode() + b"." + body, hashlib.sha256)
+    return f"sha256={digest.hexdigest()}"
+
+
+class WebhookDispatcher:
+    """
+    Delivers job-completion callbacks on its own small thread pool, so slow
+    or failing receivers never hold extraction workers. webhook_deliveries
+    is the queue: deliveries are claimed with SKIP LOCKED (safe with several
+    API and worker processes) and failed ones come back after exponential
+    backoff until WEBHOOK_MAX_ATTEMPTS.
+
+    Receivers verify X-Webhook-Signature = "sha256=" + HMAC-SHA256(secret,
+    X-Webhook-Timestamp + "." + body).
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="webhook")
+        self.http = None
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.busy = 0
+        self.delivered = 0
+        self.retried = 0
+        self.dead = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                # trust_env=False: a proxy from the environment would make the
+                # connection (and the address check) somewhere else
+                self.http = httpx.Client(timeout=WEBHOOK_TIMEOUT_SEC, transport=webhook_transport(),
+                                         trust_env=False)
+                self.thread = threading.Thread(target=self._run, name="webhook-dispatcher", daemon=True)
+                self.thread.start()
+
+    def poke(self):
+        self.wake.set()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                free = self.workers - self.busy
+                self.busy += free
+            rows = []
+            try:
+                if free:
+                    rows = claim_webhook_deliveries(free)
+            except Exception as e:
+                logger.error(f"Webhook claim failed: {e}")
+            with self.lock:
+                self.busy -= free - len(rows)
+            for row in rows:
+                self.executor.submit(self._deliver, row)
+            self.wake.wait(WEBHOOK_POLL_SEC)
+            self.wake.clear()
+
+    def _deliver(self, delivery: Dict):
+        response_status, error = None, None
+        try:
+            body = json.dumps(job_result_payload(delivery["job_id"])).encode()
+            timestamp = str(int(time.time()))
+            headers = {
+                "Content-Type": "application/json",
+                "X-Webhook-Id": str(delivery["id"]),
+                "X-Webhook-Timestamp": timestamp,
+                "X-Webhook-Attempt": str(delivery["attempts"]),
+            }
+            secret = delivery["secret"] or WEBHOOK_SIGNING_SECRET
+            if not secret:
+                # Never send unsigned (e.g. the key's endpoint was deleted since)
+                error = "No signing secret for this API key"
+            else:
+                headers["X-Webhook-Signature"] = sign_webhook(secret, timestamp, body)
+                resp = self.http.post(delivery["url"], content=body, headers=headers)
+                response_status = resp.status_code
+                if not resp.is_success:
+                    error = f"HTTP {resp.status_code}"
+        except Exception as e:
+            error = str(e) or type(e).__name__
+
+        try:
+            status = record_webhook_attempt(delivery, response_status, error)
+            with self.lock:
+                self.delivered += status == "delivered"
+                self.retried += status == "queued"
+                self.dead += status == "dead"
+            if error:
+                logger.warning(f"Webhook for {delivery['job_id']} attempt {delivery['attempts']} failed: {error} ({status})")
+        except Exception as e:
+            logger.error(f"Could not record webhook attempt for {delivery['job_id']}: {e}")
+        finally:
+            with self.lock:
+                self.busy -= 1
+            self.wake.set()
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "enabled": WEBHOOKS_ENABLED,
+                "workers": self.workers,
+                "in_flight": self.busy,
+                "delivered": self.delivered,
+                "retried": self.retried,
+                "dead": self.dead,
+            }
+
+
+webhook_dispatcher = WebhookDispatcher(WEBHOOK_WORKERS)
+
+
+@app.put("/webhook")
+async def register_webhook(request: Request, x_api_key: str = Header(None)):
+    """
+    Register (or change) this API key's callback URL: {"url": "https://..."}.
+    The response carries the signing secret, created once per key.
+    """
+    if not x_api_key or x_api_key not in VALID_API_KEYS:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    url = body.get("url") if isinstance(body, dict) else None
+    if not isinstance(url, str) or not await worker_pool.run_blocking(valid_callback_url, url):
+        raise HTTPException(
+            status_code=400,
+            detail="Body must be {\"url\": \"http(s)://...\"} with a public host"
+        )
+
+    def upsert():
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO webhook_endpoints (api_key, url, secret) VALUES (%s, %s, %s)
+                ON CONFLICT (api_key) DO UPDATE SET url = EXCLUDED.url, updated_at = now()
+                RETURNING secret
+            """, (x_api_key, url, secrets.token_hex(32)))
+            secret = cur.fetchone()[0]
+            cur.close()
+        return secret
+
+    return {"url": url, "secret": await worker_pool.run_blocking(upsert)}
+
+
+@app.delete("/webhook")
+async def delete_webhook(x_api_key: str = Header(None)):
+    if not x_api_key or x_api_key not in VALID_API_KEYS:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+
+    def delete():
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM webhook_endpoints WHERE api_key = %s", (x_api_key,))
+            cur.close()
+
+    await worker_pool.run_blocking(delete)
+    return {"status": "deleted"}
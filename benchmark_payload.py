@@ -0,0 +1,93 @@
+"""
+Payload optimiser benchmark.
+
+Sends every sample invoice to the model twice, once as the raw upload and once
+through optimise_payload, then reports request size, latency and every field
+whose extracted value changed.
+
+    python benchmark_payload.py [folder]
+
+Exits non-zero if any invoice extracted differently.
+"""
+import os
+import sys
+import time
+
+from backend import extract_invoice_from_bytes, guess_image_mime, optimise_payload, payload_params
+from image_processor2 import decode_image
+
+VALID_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def flatten(data, prefix=""):
+    """Flattens nested dicts/lists into {"items[0].rate": value, ...}."""
+    if isinstance(data, dict):
+        out = {}
+        for key, value in data.items():
+            out.update(flatten(value, f"{prefix}.{key}" if prefix else key))
+        return out
+    if isinstance(data, list):
+        out = {}
+        for idx, value in enumerate(data):
+            out.update(flatten(value, f"{prefix}[{idx}]"))
+        return out
+    return {prefix: data}
+
+
+def diff_fields(before, after):
+    a, b = flatten(before), flatten(after)
+    return [
+        (key, a.get(key), b.get(key))
+        for key in sorted(set(a) | set(b))
+        if str(a.get(key, "")).strip() != str(b.get(key, "")).strip()
+    ]
+
+
+def timed_extract(content, mime):
+    start = time.perf_counter()
+    data = extract_invoice_from_bytes(content, mime)
+    return data, time.perf_counter() - start
+
+
+def main(folder):
+    images = sorted(f for f in os.listdir(folder) if f.lower().endswith(VALID_EXTENSIONS))
+    if not images:
+        print("⚠️ No image files found in the input folder.")
+        return 0
+
+    print(f"Payload settings: {payload_params}\n")
+    total_before = total_after = 0
+    mismatched = 0
+
+    for filename in images:
+        with open(os.path.join(folder, filename), "rb") as f:
+            content = f.read()
+
+        payload, mime = optimise_payload(decode_image(content), len(content))
+        raw_data, raw_sec = timed_extract(content, guess_image_mime(content))
+        opt_data, opt_sec = timed_extract(payload, mime)
+
+        total_before += len(content)
+        total_after += len(payload)
+        changes = diff_fields(raw_data, opt_data)
+        mismatched += bool(changes)
+
+        print(f"{filename}")
+        print(f"  bytes   {len(content):>10,} -> {len(payload):>10,} "
+              f"({100 * len(payload) / len(content):.0f}%)")
+        print(f"  latency {raw_sec:>9.1f}s -> {opt_sec:>9.1f}s")
+        if changes:
+            print(f"  ❌ {len(changes)} field(s) differ:")
+            for key, before, after in changes:
+                print(f"     {key}: {before!r} -> {after!r}")
+        else:
+            print("  ✅ identical extraction")
+
+    print(f"\nTotal bytes {total_before:,} -> {total_after:,} "
+          f"({100 * total_after / total_before:.0f}%), "
+          f"{mismatched}/{len(images)} invoice(s) changed")
+    return 1 if mismatched else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1] if len(sys.argv) > 1 else "Invoices"))
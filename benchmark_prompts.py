@@ -0,0 +1,112 @@
+"""
+Prompt version comparison on a replay set.
+
+The replay set is a folder of invoice images. An image may have a ground-truth
+file next to it with the same name and a .json extension
+(e.g. INV1.JPG + INV1.json). Without one, the first prompt version's output is
+used as the reference, so accuracy then means agreement with that baseline.
+
+    python benchmark_prompts.py [folder] [version ...]
+
+For each prompt version this prints latency (mean / p50 / p95), mean prompt
+and completion tokens as reported by the provider, and field accuracy.
+Streamed calls that stop before the provider's usage event carry local
+estimates instead; they are counted in the footer. Run with
+INFERENCE_STREAMING=false for provider-reported figures only.
+"""
+import os
+import sys
+import json
+import asyncio
+import statistics
+
+from backend import PROMPT_VERSIONS, extract_invoice_async, guess_image_mime
+from benchmark_payload import flatten
+
+VALID_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def normalise(value) -> str:
+    return str(value if value is not None else "").strip().lower()
+
+
+def field_accuracy(expected, actual):
+    """Share of non-empty expected fields that were extracted with the same value."""
+    want = {k: v for k, v in flatten(expected).items() if normalise(v)}
+    got = flatten(actual)
+    if not want:
+        return None
+    hits = sum(normalise(got.get(key)) == normalise(value) for key, value in want.items())
+    return hits / len(want)
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def run_version(version, samples):
+    results = []
+    for filename, content in samples:
+        calls = []
+        try:
+            data = await extract_invoice_async(content, guess_image_mime(content), version, calls)
+        except Exception as e:
+            print(f"  ❌ {version} {filename}: {e}")
+            data = {}
+        results.append({"filename": filename, "data": data, "calls": calls})
+    return results
+
+
+async def main(folder, versions):
+    images = sorted(f for f in os.listdir(folder) if f.lower().endswith(VALID_EXTENSIONS))
+    if not images:
+        print("⚠️ No image files found in the input folder.")
+        return
+
+    samples, truth = [], {}
+    for filename in images:
+        with open(os.path.join(folder, filename), "rb") as f:
+            samples.append((filename, f.read()))
+        truth_path = os.path.join(folder, os.path.splitext(filename)[0] + ".json")
+        if os.path.exists(truth_path):
+            with open(truth_path) as f:
+                truth[filename] = json.load(f)
+
+    runs = {}
+    for version in versions:
+        print(f"Running '{version}' on {len(samples)} invoice(s)...")
+        runs[version] = await run_version(version, samples)
+
+    baseline = {r["filename"]: r["data"] for r in runs[versions[0]]}
+    print(f"\nReference: {len(truth)} ground-truth file(s), "
+          f"baseline '{versions[0]}' for the rest\n")
+    print(f"{'version':<10} {'mean s':>7} {'p50 s':>7} {'p95 s':>7} "
+          f"{'prompt tok':>11} {'compl tok':>10} {'accuracy':>9}")
+
+    estimated, total = 0, 0
+    for version, results in runs.items():
+        calls = [c for r in results for c in r["calls"]]
+        estimated += sum(c.get("estimated", False) for c in calls)
+        total += len(calls)
+        latencies = [c["latency_ms"] / 1000 for c in calls] or [0.0]
+        accuracies = [
+            field_accuracy(truth.get(r["filename"], baseline[r["filename"]]), r["data"])
+            for r in results
+        ]
+        accuracies = [a for a in accuracies if a is not None]
+        print(f"{version:<10} {statistics.mean(latencies):>7.1f} "
+              f"{percentile(latencies, 50):>7.1f} {percentile(latencies, 95):>7.1f} "
+              f"{statistics.mean([c['prompt_tokens'] for c in calls] or [0]):>11.0f} "
+              f"{statistics.mean([c['completion_tokens'] for c in calls] or [0]):>10.0f} "
+              f"{(100 * statistics.mean(accuracies)) if accuracies else float('nan'):>8.1f}%")
+
+    if estimated:
+        print(f"\n⚠️ Token figures of {estimated}/{total} call(s) are local estimates "
+              f"(stream closed before the usage event)")
+
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else "Invoices"
+    versions = sys.argv[2:] or list(PROMPT_VERSIONS)
+    asyncio.run(main(folder, versions))
@@ -1,34 +1,127 @@
 import os
+import sys
+import time
 import cv2
+import fitz  # PyMuPDF
 import numpy as np
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
-def enhance_image_for_ocr(
-    image_path: str,
-    scale_factor: float = 1.5,
-    save_path: Optional[str] = None
-) -> np.ndarray:
+def to_grayscale(img: np.ndarray) -> np.ndarray:
     """
-    Loads an image and applies pre-processing techniques to enhance text
-    contrast and clarity for OCR.
+    Converts a BGR image to single-channel grayscale (no-op if already gray).
     """
-    # 1. Load the image
-    img = cv2.imread(image_path)
-    if img is None:
+    if img.ndim == 2:
+        return img
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def load_grayscale(image_path: str) -> np.ndarray:
+    """
+    Loads an image straight into grayscale.
+    """
+    gray = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
         raise FileNotFoundError(f"Could not open or find the image at: {image_path}")
+    return gray
+
+
+def dhash(gray: np.ndarray, hash_size: int = 8) -> int:
+    """
+    Computes a difference hash (dHash) of a grayscale image.
+
+    The image is shrunk to (hash_size + 1) x hash_size and each bit records
+    whether a pixel is brighter than its right-hand neighbour, so re-shot
+    photos of the same page land within a few bits of each other.
+    """
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    diff = small[:, 1:] > small[:, :-1]
+    value = 0
+    for bit in diff.flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def block_means(gray: np.ndarray, grid: int = 128) -> bytes:
+    """
+    Fingerprint for confirming a near-duplicate: the mean brightness of each
+    cell of a grid x grid layout. Unlike dHash it keeps enough detail for a
+    changed amount or invoice number to move at least one cell noticeably,
+    while re-encoding the same image at another JPEG quality moves none by
+    more than a few levels.
+    """
+    small = cv2.resize(gray, (grid, grid), interpolation=cv2.INTER_AREA)
+    return small.astype(np.uint8).tobytes()
+
+
+def max_block_difference(a: bytes, b: bytes) -> int:
+    """
+    Largest per-cell brightness difference between two block_means fingerprints.
+    """
+    if len(a) != len(b):
+        return 255
+    left = np.frombuffer(a, dtype=np.uint8).astype(np.int16)
+    right = np.frombuffer(b, dtype=np.uint8).astype(np.int16)
+    return int(np.abs(left - right).max())
+
+
+def decode_image(data: bytes) -> np.ndarray:
+    """
+    Decodes encoded image bytes (JPEG/PNG/...) into a BGR array.
+    """
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Could not decode image bytes")
+    return img
+
+
+def encode_image(img: np.ndarray, ext: str = ".png", quality: Optional[int] = None) -> bytes:
+    """
+    Encodes an array back into image bytes without touching the filesystem.
+    """
+    params = []
+    if quality is not None:
+        if ext in (".jpg", ".jpeg"):
+            params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        elif ext == ".webp":
+            params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    ok, buf = cv2.imencode(ext, img, params)
+    if not ok:
+        raise ValueError(f"Could not encode image as {ext}")
+    return buf.tobytes()
 
-    # 2. Rescale/Upscale (Improves DPI and small text)
+
+def shrink_to_max_edge(img: np.ndarray, max_edge: int) -> np.ndarray:
+    """
+    Downscales so the longest side is at most max_edge (never upscales).
+    """
+    h, w = img.shape[:2]
+    scale = max_edge / max(h, w)
+    if scale >= 1:
+        return img
+    return cv2.resize(img, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+
+def enhance_image(img: np.ndarray, scale_factor: float = 1.5) -> np.ndarray:
+    """
+    Applies pre-processing techniques to an in-memory image to enhance text
+    contrast and clarity for OCR.
+    """
+    # 1. Rescale/Upscale (Improves DPI and small text)
     h, w = img.shape[:2]
     img = cv2.resize(img, (int(w * scale_factor), int(h * scale_factor)),
                      interpolation=cv2.INTER_LINEAR)
 
-    # 3. Grayscale Conversion
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    # 2. Grayscale Conversion
+    gray = to_grayscale(img)
 
-    # 4. Noise Reduction
+    # 3. Noise Reduction
     denoised = cv2.fastNlMeansDenoising(gray, h=10, templateWindowSize=7, searchWindowSize=21)
 
-    # 5. Adaptive Thresholding (Binarization)
+    # 4. Adaptive Thresholding (Binarization)
     binary = cv2.adaptiveThreshold(
         denoised,
         255,
@@ -37,8 +130,163 @@ def enhance_image_for_ocr(
         blockSize=11,
         C=2
     )
+    return binary
+
+
+PREPROCESS_PROFILES = ("none", "fast", "full", "auto")
+
+# Below this Laplacian variance a photo is treated as blurry
+BLUR_THRESHOLD = float(os.getenv("PREPROCESS_BLUR_THRESHOLD", 100.0))
+# Above this estimated noise sigma a photo is treated as noisy
+NOISE_THRESHOLD = float(os.getenv("PREPROCESS_NOISE_THRESHOLD", 5.0))
+# Quality is measured on a downscaled copy to keep the estimate cheap
+QUALITY_SAMPLE_EDGE = 1000
+
+
+def fast_enhance_image(img: np.ndarray) -> np.ndarray:
+    """
+    Cheap variant of enhance_image: no upscale and a 3x3 median filter
+    instead of non-local-means denoising.
+    """
+    gray = to_grayscale(img)
+    denoised = cv2.medianBlur(gray, 3)
+    return cv2.adaptiveThreshold(
+        denoised,
+        255,
+        cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+        cv2.THRESH_BINARY,
+        blockSize=11,
+        C=2
+    )
+
+
+def measure_image_quality(img: np.ndarray) -> Dict[str, float]:
+    """
+    Estimates sharpness (variance of the Laplacian, higher is sharper) and
+    noise sigma (Immerkaer's fast estimator).
+    """
+    gray = to_grayscale(img)
+    h, w = gray.shape[:2]
+    scale = QUALITY_SAMPLE_EDGE / max(h, w)
+    if scale < 1:
+        gray = cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
 
-    # 6. Save the result (optional)
+    blur = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    kernel = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float64)
+    response = cv2.filter2D(gray.astype(np.float64), -1, kernel)[1:-1, 1:-1]
+    noise = float(np.sqrt(np.pi / 2) * np.abs(response).mean() / 6)
+    return {"blur": round(blur, 2), "noise": round(noise, 2)}
+
+
+def select_profile(quality: Dict[str, float]) -> str:
+    """
+    Escalates to the expensive path only for blurry or noisy photos.
+    """
+    if quality["blur"] < BLUR_THRESHOLD or quality["noise"] > NOISE_THRESHOLD:
+        return "full"
+    return "fast"
+
+
+def preprocess_image(img: np.ndarray, profile: str = "auto") -> Tuple[np.ndarray, str]:
+    """
+    Runs the named preprocessing profile and returns (image, profile_used).
+
+    - none: image unchanged
+    - fast: grayscale + median filter + adaptive threshold, no upscale
+    - full: enhance_image (upscale + NL-means denoise + threshold)
+    - auto: fast or full depending on measure_image_quality
+    """
+    if profile == "auto":
+        profile = select_profile(measure_image_quality(img))
+
+    if profile == "none":
+        return img, profile
+    if profile == "fast":
+        return fast_enhance_image(img), profile
+    if profile == "full":
+        return enhance_image(img), profile
+    raise ValueError(f"Unknown preprocessing profile: {profile}")
+
+
+def estimate_text_lines(gray: np.ndarray, width: int = 1000) -> int:
+    """
+    Rough count of printed text lines on the page, used to size the model's
+    output budget (item rows are a subset of text lines).
+
+    Table rules are removed with long horizontal/vertical openings, characters
+    are merged into words, and word boxes are grouped by their vertical centre.
+    """
+    h, w = gray.shape[:2]
+    scale = width / w
+    small = cv2.resize(gray, (width, max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+
+    ink = cv2.adaptiveThreshold(
+        small, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 31, 20
+    )
+    for kernel in ((width // 8, 1), (1, width // 8)):
+        rules = cv2.morphologyEx(ink, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, kernel))
+        ink = cv2.subtract(ink, rules)
+
+    words = cv2.dilate(ink, cv2.getStructuringElement(cv2.MORPH_RECT, (15, 1)))
+    _, _, stats, _ = cv2.connectedComponentsWithStats(words)
+
+    # Word-sized boxes only (skip specks, logos and photo backgrounds)
+    centres = sorted(
+        y + bh / 2 for x, y, bw, bh, _ in stats[1:]
+        if 6 <= bh <= 60 and bw >= 20
+    )
+
+    lines, last = 0, None
+    for centre in centres:
+        if last is None or centre - last > 10:
+            lines += 1
+        last = centre
+    return lines
+
+
+def is_pdf(data: bytes) -> bool:
+    return data[:5] == b"%PDF-"
+
+
+def read_pdf_text(pdf_path: str) -> List[str]:
+    """
+    Returns the embedded text layer of every page, in reading order. Pages
+    that are scans have no text layer and come back as empty strings.
+    """
+    with fitz.open(pdf_path) as doc:
+        return [page.get_text("text", sort=True).strip() for page in doc]
+
+
+def render_pdf_page(pdf_path: str, page_number: int, dpi: int = 200) -> bytes:
+    """
+    Rasterises one page (0-based) to PNG bytes at the given DPI.
+
+    Takes a path rather than bytes so it can run in a separate process
+    without pickling the whole document for every page.
+    """
+    with fitz.open(pdf_path) as doc:
+        pix = doc[page_number].get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False)
+        return pix.tobytes("png")
+
+
+def enhance_image_for_ocr(
+    image_path: str,
+    scale_factor: float = 1.5,
+    save_path: Optional[str] = None
+) -> np.ndarray:
+    """
+    Loads an image and applies pre-processing techniques to enhance text
+    contrast and clarity for OCR.
+    """
+    # 1. Load the image
+    img = cv2.imread(image_path)
+    if img is None:
+        raise FileNotFoundError(f"Could not open or find the image at: {image_path}")
+
+    # 2. Enhance
+    binary = enhance_image(img, scale_factor=scale_factor)
+
+    # 3. Save the result (optional)
     if save_path:
         cv2.imwrite(save_path, binary)
         print(f"✅ Enhanced image saved to {save_path}")
@@ -79,7 +327,56 @@ def process_images_in_folder(input_folder: str, output_folder: str, scale_factor
     print(f"\n✅ All images processed. Enhanced files saved in: {output_folder}")
 
 
+def benchmark_profiles(input_folder: str, repeats: int = 3):
+    """
+    Times every preprocessing profile on each image in a folder and prints
+    the per-image timings, the auto choice and the per-profile averages.
+    """
+    valid_extensions = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff")
+    images = sorted(f for f in os.listdir(input_folder) if f.lower().endswith(valid_extensions))
+    if not images:
+        print("⚠️ No image files found in the input folder.")
+        return
+
+    profiles = ("none", "fast", "full")
+    totals = {p: 0.0 for p in profiles + ("auto",)}
+
+    print(f"{'image':<70} {'blur':>9} {'noise':>6} " +
+          " ".join(f"{p + ' ms':>9}" for p in profiles) + f" {'auto':>11}")
+
+    for filename in images:
+        with open(os.path.join(input_folder, filename), "rb") as f:
+            img = decode_image(f.read())
+
+        timings = {}
+        for profile in profiles:
+            start = time.perf_counter()
+            for _ in range(repeats):
+                preprocess_image(img, profile)
+            timings[profile] = 1000 * (time.perf_counter() - start) / repeats
+            totals[profile] += timings[profile]
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            _, chosen = preprocess_image(img, "auto")
+        auto_ms = 1000 * (time.perf_counter() - start) / repeats
+        totals["auto"] += auto_ms
+
+        quality = measure_image_quality(img)
+        print(f"{filename[:70]:<70} {quality['blur']:>9.1f} {quality['noise']:>6.2f} " +
+              " ".join(f"{timings[p]:>9.1f}" for p in profiles) +
+              f" {chosen:>4}{auto_ms:>7.1f}")
+
+    print("\nAverage per image (ms): " +
+          ", ".join(f"{p}={totals[p] / len(images):.1f}" for p in totals))
+
+
 if __name__ == "__main__":
+    # python image_processor2.py --benchmark [folder]
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        benchmark_profiles(sys.argv[2] if len(sys.argv) > 2 else "Invoices")
+        sys.exit(0)
+
     # 💡 EDIT THESE PATHS
     input_folder = r"D:\\TVS_Invoice-Extraction\\Input_images"
     output_folder = r"D:\\TVS_Invoice-Extraction\\preprocessed_images"
@@ -0,0 +1,11 @@
+-- document_data is shared with other services, so the API does not alter it
+-- at startup. Apply this once, as a role allowed to ALTER document_data,
+-- before deploying the /check-job ETag support; the API refuses to start
+-- while the version column is missing.
+--
+--     psql "$DATABASE_URL" -f migrations/001_document_data_version.sql
+
+CREATE INDEX IF NOT EXISTS document_data_job_id_idx ON document_data (job_id);
+
+-- Bumped by every status/data write; /check-job derives its ETag from it
+ALTER TABLE document_data ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
@@ -0,0 +1,241 @@
+"""
+Local stand-in for the watsonx.ai endpoints used by backend.py.
+
+    uvicorn stub_server:app --port 8099
+
+    IBM_SERVICE_URL=http://127.0.0.1:8099
+    IBM_IAM_URL=http://127.0.0.1:8099/identity/token
+
+STUB_LATENCY_SEC controls how long each chat call takes. A request carrying an
+assistant message (a continuation) is answered with the rest of the canned
+output after that message. Prompts asking for the compact wire format get the
+canned invoice in that format, following the key map stated in the prompt.
+STUB_QUOTA_RPS > 0 answers requests above that rate with 429 and Retry-After.
+While the file named by STUB_OUTAGE_FILE exists, chat calls fail with 503.
+STUB_CAPACITY > 0 simulates provider load: latency grows once more than that
+many chat calls are in flight. STUB_SLOW_PCT percent of calls take
+STUB_SLOW_FACTOR times as long (a latency tail).
+"""
+import os
+import re
+import json
+import random
+import time
+import uuid
+import asyncio
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+STUB_LATENCY_SEC = float(os.getenv("STUB_LATENCY_SEC", 2.0))
+# Number of item rows in the canned invoice (longer outputs exercise budgets)
+STUB_ITEMS = int(os.getenv("STUB_ITEMS", 1))
+# Streaming: delay per ~4-char token and chatter appended after the JSON
+STUB_TOKEN_DELAY_SEC = float(os.getenv("STUB_TOKEN_DELAY_SEC", 0.002))
+STUB_TRAILER = os.getenv(
+    "STUB_TRAILER",
+    "\n\nNote: all values above were read directly from the invoice image. " * 20
+)
+
+STUB_QUOTA_RPS = float(os.getenv("STUB_QUOTA_RPS", 0))
+STUB_OUTAGE_FILE = os.getenv("STUB_OUTAGE_FILE", "/tmp/watsonx_stub_outage")
+STUB_CAPACITY = int(os.getenv("STUB_CAPACITY", 0))
+STUB_SLOW_PCT = float(os.getenv("STUB_SLOW_PCT", 0))
+STUB_SLOW_FACTOR = float(os.getenv("STUB_SLOW_FACTOR", 5))
+
+SAMPLE_INVOICE = {
+    "invoiceNumber": "INV-001",
+    "invoiceNumberType": "Printed",
+    "invoiceDate": "01/01/2026",
+    "DealerName": "Stub Mobiles",
+    "DealerPhone": "9876543210",
+    "DealerAddress": "1 Main Road, Chennai 600001",
+    "EMIAmount": "",
+    "gstNumber": "33AABCT1234F1Z5",
+    "customerName": "Test Customer",
+    "customerPhone": "9123456780",
+    "customerAddress": "",
+    "downPayment": "2000",
+    "netTotal": "15999",
+    "stampPresent": "Present",
+    "informationInStamp": "Stub Mobiles",
+    "signaturePresent": "Yes",
+    "hypothecationStamp": "Present",
+    "stampCompanyMatching_score": 95,
+    "items": [{
+        "itemNo": "1",
+        "Asset Model No": "Galaxy A15",
+        "brandName": "Samsung",
+        "imeiNumber": "356789012345678",
+        "serialNumber": "",
+        "quantity": "1",
+        "rate": "13558",
+        "sgst": "9",
+        "cgst": "9",
+        "igst": "",
+        "tax": "",
+        "itemAmount": "15999"
+    }]
+}
+
+app = FastAPI(title="watsonx stub")
+recent_requests = []
+active_calls = 0
+
+
+def loaded_latency() -> float:
+    latency = STUB_LATENCY_SEC
+    if STUB_CAPACITY > 0:
+        latency *= max(1.0, active_calls / STUB_CAPACITY)
+    if random.uniform(0, 100) < STUB_SLOW_PCT:
+        latency *= STUB_SLOW_FACTOR
+    return latency
+
+
+def over_quota():
+    if os.path.exists(STUB_OUTAGE_FILE):
+        return JSONResponse({"errors": [{"code": "service_unavailable"}]}, status_code=503)
+    # Sliding one-second window over accepted requests
+    if STUB_QUOTA_RPS <= 0:
+        return None
+    now = time.monotonic()
+    recent_requests[:] = [t for t in recent_requests if now - t < 1.0]
+    if len(recent_requests) >= STUB_QUOTA_RPS:
+        return JSONResponse(
+            {"errors": [{"code": "rate_limit_exceeded"}]}, status_code=429,
+            headers={"Retry-After": "1"}
+        )
+    recent_requests.append(now)
+    return None
+
+
+def prompt_text(body: dict) -> str:
+    return " ".join(
+        part.get("text", "")
+        for message in body.get("messages", []) if isinstance(message["content"], list)
+        for part in message["content"]
+    )
+
+
+def to_wire(invoice: dict, prompt: str) -> dict:
+    keys = dict(re.findall(r"(\w+)=(\w+)", prompt.split("OUTPUT FORMAT (compact)")[1].split(")")[0]))
+    order = re.search(r"exact order:\s*\[([^\]]+)\]", prompt).group(1).split(", ")
+    wire = {keys.get(key, key): value for key, value in invoice.items()}
+    wire["items"] = [[item.get(field, "") for field in order] for item in invoice["items"]]
+    return wire
+
+
+def stub_completion(body: dict) -> str:
+    invoice = dict(SAMPLE_INVOICE)
+    item = SAMPLE_INVOICE["items"][0]
+    invoice["items"] = [
+        {**item, "itemNo": str(n), "imeiNumber": str(356789012345678 + n)}
+        for n in range(1, STUB_ITEMS + 1)
+    ]
+    prompt = prompt_text(body)
+    if "OUTPUT FORMAT (compact)" in prompt:
+        invoice = to_wire(invoice, prompt)
+    return json.dumps(invoice)
+
+
+def remaining_output(body: dict, content: str) -> str:
+    # Continuation requests replay the cut-off answer as an assistant message
+    partial = [m["content"] for m in body.get("messages", []) if m["role"] == "assistant"]
+    if partial and content.startswith(partial[-1]):
+        return content[len(partial[-1]):]
+    return content
+
+
+@app.post("/identity/token")
+async def iam_token():
+    return {
+        "access_token": "stub-token",
+        "token_type": "Bearer",
+        "expires_in": 3600,
+        "expiration": int(time.time()) + 3600
+    }
+
+
+def count_prompt_tokens(body: dict) -> int:
+    # Rough token counts: ~4 chars per token plus a flat cost per image
+    prompt_tokens = 0
+    for message in body.get("messages", []):
+        parts = message["content"] if isinstance(message["content"], list) else [
+            {"type": "text", "text": message["content"]}
+        ]
+        for part in parts:
+            prompt_tokens += len(part.get("text", "")) // 4 if part["type"] == "text" else 1500
+    return prompt_tokens
+
+
+@app.post("/ml/v1/text/chat")
+async def chat(request: Request):
+    body = await request.json()
+    global active_calls
+    if (throttled := over_quota()) is not None:
+        return throttled
+    active_calls += 1
+    try:
+        await asyncio.sleep(loaded_latency())
+    finally:
+        active_calls -= 1
+
+    content = remaining_output(body, stub_completion(body))
+    prompt_tokens = count_prompt_tokens(body)
+    completion_tokens = len(content) // 4
+
+    # Honour the output budget the way the real endpoint does
+    finish_reason = "stop"
+    max_tokens = body.get("max_tokens")
+    if max_tokens and completion_tokens > max_tokens:
+        content = content[:max_tokens * 4]
+        completion_tokens = max_tokens
+        finish_reason = "length"
+
+    return {
+        "id": f"chat-{uuid.uuid4().hex}",
+        "model_id": body.get("model_id"),
+        "created": int(time.time()),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": finish_reason
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    }
+
+
+@app.post("/ml/v1/text/chat_stream")
+async def chat_stream(request: Request):
+    body = await request.json()
+    if (throttled := over_quota()) is not None:
+        return throttled
+    content = remaining_output(body, stub_completion(body) + STUB_TRAILER)
+    tokens = [content[i:i + 4] for i in range(0, len(content), 4)]
+    max_tokens = body.get("max_tokens") or len(tokens)
+    prompt_tokens = count_prompt_tokens(body)
+
+    async def events():
+        await asyncio.sleep(STUB_LATENCY_SEC / 2)  # time to first token
+        sent = 0
+        for n, token in enumerate(tokens[:max_tokens], start=1):
+            await asyncio.sleep(STUB_TOKEN_DELAY_SEC)
+            event = {"choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+            yield f"id: {n}\nevent: message\ndata: {json.dumps(event)}\n\n"
+            sent = n
+        finish_reason = "length" if sent < len(tokens) else "stop"
+        event = {
+            "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": sent,
+                "total_tokens": prompt_tokens + sent
+            }
+        }
+        yield f"id: {sent + 1}\nevent: message\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+import pytest
+
+import backend
+from backend import AdaptiveConcurrencyLimit, CircuitBreaker, CircuitOpenError, ProviderRateLimiter
+
+
+def open_breaker(reset_sec=0.0, trial_timeout_sec=60.0):
+    breaker = CircuitBreaker(1, reset_sec, 1, "fail", trial_timeout_sec)
+    breaker.record(TimeoutError("backend down"))
+    assert breaker.state == "open"
+    return breaker
+
+
+def test_cancelled_trial_queued_on_concurrency_limit_is_released(monkeypatch):
+    breaker = open_breaker()
+    limit = AdaptiveConcurrencyLimit(1, 1, 1, adaptive=False)
+    monkeypatch.setattr(backend, "inference_breaker", breaker)
+    monkeypatch.setattr(backend, "concurrency_limit", limit)
+    monkeypatch.setattr(backend, "rate_limiter", ProviderRateLimiter(0, 1, 0, 4000))
+
+    async def scenario():
+        await limit.acquire()  # the only slot is busy, so the trial queues
+        trial = asyncio.create_task(backend.chat_completion([], {}))
+        await asyncio.sleep(0.01)
+        assert breaker.state == "half_open" and breaker.trials == 1
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        limit.release()
+
+    asyncio.run(scenario())
+    assert breaker.trials == 0
+    assert limit.in_flight == 0
+    # The next call is admitted as a fresh trial instead of being rejected
+    assert breaker._admit() == (0.0, True)
+
+
+def test_half_open_trial_without_outcome_times_out():
+    breaker = open_breaker(reset_sec=0.0, trial_timeout_sec=0.05)
+    assert breaker._admit() == (0.0, True)
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(breaker.before_call())
+
+    time.sleep(0.06)
+    # The silent trial re-opens the circuit; after reset_sec a new trial goes through
+    assert breaker._admit() == (0.0, True)
+    assert breaker.times_opened == 2
+
+
+def test_release_only_returns_trial_slots():
+    breaker = open_breaker()
+    assert breaker._admit() == (0.0, True)
+    breaker.release(trial=False)
+    assert breaker.trials == 1
+    breaker.release(trial=True)
+    assert breaker.trials == 0
@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+
+from backend import AdaptiveConcurrencyLimit
+
+
+def test_waiter_cancelled_after_grant_gives_slot_back():
+    limit = AdaptiveConcurrencyLimit(1, 1, 1, adaptive=False)
+
+    async def scenario():
+        await limit.acquire()
+        waiter = asyncio.create_task(limit.acquire())
+        await asyncio.sleep(0)
+        assert len(limit.waiters) == 1
+
+        # _grant runs via call_soon: set the result, then cancel the task
+        # before it gets to resume
+        limit.release()
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    asyncio.run(scenario())
+    assert limit.in_flight == 0
+    assert not limit.waiters
+
+
+def test_waiter_cancelled_while_queued_leaves_no_trace():
+    limit = AdaptiveConcurrencyLimit(1, 1, 1, adaptive=False)
+
+    async def scenario():
+        await limit.acquire()
+        waiter = asyncio.create_task(limit.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        limit.release()
+
+    asyncio.run(scenario())
+    assert limit.in_flight == 0
+    assert not limit.waiters
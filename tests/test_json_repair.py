@@ -0,0 +1,41 @@
+import pytest
+
+from backend import MalformedOutputError, parse_json_robust
+
+
+def test_missing_comma_between_items_is_not_cut_back():
+    raw = '{"invoiceNumber":"1","netTotal":"5","items":[{"x":"1"} {"x":"2"}],"gstNumber":"g"}'
+    with pytest.raises(MalformedOutputError):
+        parse_json_robust(raw)
+
+
+def test_invalid_number_does_not_drop_the_field():
+    raw = '{"invoiceNumber":"1","quantity":01,"gstNumber":"g"}'
+    with pytest.raises(MalformedOutputError):
+        parse_json_robust(raw)
+
+
+def test_trailing_commas_are_removed_and_reported():
+    repairs = []
+    data = parse_json_robust('```json\n{"a":"1","items":[{"x":"1",},],}\n```', repairs)
+    assert data == {"a": "1", "items": [{"x": "1"}]}
+    assert repairs == ["removed 3 trailing comma(s)"]
+
+
+def test_commas_inside_strings_are_left_alone():
+    repairs = []
+    data = parse_json_robust('{"address":"Plot 4,}","items":[],}', repairs)
+    assert data == {"address": "Plot 4,}", "items": []}
+    assert repairs == ["removed 1 trailing comma(s)"]
+
+
+def test_cut_off_output_is_closed_between_values():
+    repairs = []
+    data = parse_json_robust('{"a":"1","items":[{"x":"1"},', repairs)
+    assert data == {"a": "1", "items": [{"x": "1"}]}
+    assert repairs == ["removed 1 trailing comma(s)", "closed 2 bracket(s) of cut-off output"]
+
+
+def test_output_cut_inside_a_value_is_rejected():
+    with pytest.raises(MalformedOutputError):
+        parse_json_robust('{"a":"1","gstNumber":"33AB')
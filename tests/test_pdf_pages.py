@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+import backend
+
+
+def test_failing_page_cancels_the_other_pages(monkeypatch):
+    cancelled = []
+
+    async def read_text(pdf_path):
+        return ["x" * 1000] * 3
+
+    async def extract(payload, mime, prompt_version, calls, max_new_tokens, publish, text=None):
+        calls.append(text)
+        if len(calls) == 2:
+            raise backend.MalformedOutputError("bad page")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    monkeypatch.setattr(backend, "PDF_TEXT_LAYER", "prefer")
+    monkeypatch.setattr(backend, "PDF_TEXT_MIN_CHARS", 1)
+    monkeypatch.setattr(backend.pdf_renderer, "read_text", read_text)
+    monkeypatch.setattr(backend, "extract_invoice_async", extract)
+
+    async def scenario():
+        with pytest.raises(backend.MalformedOutputError):
+            await asyncio.wait_for(
+                backend.extract_pdf_invoice("doc.pdf", {"prompt_version": "full"}), 5
+            )
+        # Already cancelled when the error surfaces, not left running
+        assert len(cancelled) == 2
+
+    asyncio.run(scenario())
@@ -0,0 +1,67 @@
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import httpx
+import pytest
+
+import backend
+
+
+class Recorder(BaseHTTPRequestHandler):
+    hosts = []
+
+    def do_POST(self):
+        Recorder.hosts.append(self.headers["Host"])
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer(("127.0.0.1", 0), Recorder)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def fake_dns(monkeypatch, answers):
+    """getaddrinfo answering callback.example with the next answer on every call."""
+    lookups = []
+    real_getaddrinfo = socket.getaddrinfo
+
+    def getaddrinfo(host, port, *args, **kwargs):
+        if host != "callback.example":
+            return real_getaddrinfo(host, port, *args, **kwargs)
+        lookups.append(host)
+        address = answers[min(len(lookups), len(answers)) - 1]
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, port))]
+
+    monkeypatch.setattr(backend.socket, "getaddrinfo", getaddrinfo)
+    return lookups
+
+
+def test_private_address_is_refused_at_connect(monkeypatch):
+    lookups = fake_dns(monkeypatch, ["169.254.169.254"])
+    with httpx.Client(transport=backend.webhook_transport(), trust_env=False) as client:
+        with pytest.raises(httpx.ConnectError, match="public address"):
+            client.post("http://callback.example/hook", content=b"{}")
+    assert lookups == ["callback.example"]
+
+
+def test_connects_to_the_address_it_checked_and_keeps_the_host(monkeypatch, server):
+    # The second lookup would rebind to an internal address; there must not be one
+    lookups = fake_dns(monkeypatch, ["127.0.0.1", "10.0.0.1"])
+    monkeypatch.setattr(backend, "is_public_address", lambda address: address == "127.0.0.1")
+    Recorder.hosts = []
+    with httpx.Client(transport=backend.webhook_transport(), trust_env=False) as client:
+        resp = client.post(f"http://callback.example:{server}/hook", content=b"{}")
+    assert resp.status_code == 204
+    assert lookups == ["callback.example"]
+    assert Recorder.hosts == [f"callback.example:{server}"]
@@ -0,0 +1,63 @@
+"""
+Local receiver for testing webhook callbacks.
+
+    uvicorn webhook_sink:app --port 8098
+
+Start the API with WEBHOOK_ALLOW_PRIVATE_TARGETS=true (callbacks to loopback
+are refused otherwise), register the sink with PUT /webhook
+{"url": "http://127.0.0.1:8098/callback"} (or send X-Callback-Url per job) and
+set SINK_SECRET to the returned secret to check signatures. SINK_FAIL_FIRST makes the first N calls per job fail with
+503 to exercise retries. GET /received lists what arrived.
+"""
+import os
+import hmac
+import json
+import time
+import hashlib
+from collections import defaultdict
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+SINK_SECRET = os.getenv("SINK_SECRET", "")
+SINK_FAIL_FIRST = int(os.getenv("SINK_FAIL_FIRST", 0))
+SINK_MAX_SKEW_SEC = int(os.getenv("SINK_MAX_SKEW_SEC", 300))
+
+app = FastAPI(title="webhook sink")
+received = []
+attempts = defaultdict(int)
+
+
+def signature_ok(headers, body: bytes) -> bool:
+    if not SINK_SECRET:
+        return True
+    timestamp = headers.get("x-webhook-timestamp", "")
+    if not timestamp.isdigit() or abs(time.time() - int(timestamp)) > SINK_MAX_SKEW_SEC:
+        return False
+    expected = hmac.new(SINK_SECRET.encode(), timestamp.encode() + b"." + body, hashlib.sha256)
+    return hmac.compare_digest(f"sha256={expected.hexdigest()}", headers.get("x-webhook-signature", ""))
+
+
+@app.post("/callback")
+async def callback(request: Request):
+    body = await request.body()
+    if not signature_ok(request.headers, body):
+        return JSONResponse({"error": "bad signature"}, status_code=401)
+
+    payload = json.loads(body)
+    attempts[payload["jobId"]] += 1
+    if attempts[payload["jobId"]] <= SINK_FAIL_FIRST:
+        return JSONResponse({"error": "try again"}, status_code=503)
+
+    received.append({
+        "delivery": request.headers.get("x-webhook-id"),
+        "attempt": request.headers.get("x-webhook-attempt"),
+        "payload": payload
+    })
+    print(f"✅ {payload['jobId']}: {payload['status']} ({payload['count']} file(s))")
+    return {"ok": True}
+
+
+@app.get("/received")
+async def list_received():
+    return received
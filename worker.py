@@ -0,0 +1,117 @@
+"""
+Queue worker for JOB_QUEUE_BACKEND=postgres.
+
+Claims invoices from the invoice_queue table and runs each one through
+background_invoice_processing, the same pipeline the API uses in memory mode.
+
+    JOB_QUEUE_BACKEND=postgres python worker.py
+
+Start as many workers as needed, on any machine that reaches the database
+and the shared SPOOL_DIR. Each runs up to WORKER_POOL_SIZE invoices at once
+and holds a lease on each; a worker that dies simply stops renewing them and
+its invoices are picked up again once the leases expire. SIGTERM/SIGINT stop
+claiming and let running invoices finish.
+
+The provider quota (RATE_LIMIT_RPS / RATE_LIMIT_TPM) is split evenly across
+processes: set RATE_LIMIT_PROCESSES to the number of workers running. Each
+logs its effective share at startup.
+"""
+import os
+import socket
+import signal
+import asyncio
+
+from backend import (
+    JOB_QUEUE_BACKEND, QUEUE_LEASE_SEC, background_invoice_processing, bootstrap_schema,
+    claim_queue_items, finish_queue_item, is_retryable, logger, reap_dead_leases,
+    renew_queue_leases, retry_queue_item, worker_pool
+)
+
+QUEUE_WORKER_ID = os.getenv("QUEUE_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+QUEUE_POLL_SEC = float(os.getenv("QUEUE_POLL_SEC", 1.0))
+QUEUE_SHUTDOWN_GRACE_SEC = float(os.getenv("QUEUE_SHUTDOWN_GRACE_SEC", 60))
+
+leased = {}  # queue id -> row, for lease renewal
+
+
+async def process_item(row):
+    """Run one claimed invoice and record the outcome on its queue row."""
+    item_id, attempts = row["id"], row["attempts"]
+    try:
+        error = await background_invoice_processing(
+            row["job_id"], row["filename"], row["spool_path"], row["api_key"],
+            row["cache_key"], row["options"], final_attempt=attempts >= row["max_attempts"]
+        )
+        if error is None:
+            status = "done"
+        else:
+            status = "dead" if is_retryable(error) else "failed"
+        await worker_pool.run_blocking(
+            finish_queue_item, item_id, QUEUE_WORKER_ID, status,
+            None if error is None else str(error)
+        )
+    except Exception as e:
+        delay = await worker_pool.run_blocking(
+            retry_queue_item, item_id, QUEUE_WORKER_ID, attempts, str(e)
+        )
+        logger.warning(
+            f"Attempt {attempts}/{row['max_attempts']} for {row['job_id']}/{row['filename']} "
+            f"failed ({e}); retrying in {delay:.0f}s"
+        )
+    finally:
+        leased.pop(item_id, None)
+
+
+async def renew_leases():
+    # Runs until cancelled, so invoices finishing during shutdown keep their leases
+    while True:
+        await asyncio.sleep(QUEUE_LEASE_SEC / 3)
+        try:
+            await worker_pool.run_blocking(renew_queue_leases, QUEUE_WORKER_ID, list(leased))
+        except Exception as e:
+            logger.error(f"Lease renewal failed: {e}")
+
+
+async def main():
+    if JOB_QUEUE_BACKEND != "postgres":
+        logger.warning("JOB_QUEUE_BACKEND is not 'postgres'; the API will not enqueue anything")
+    bootstrap_schema()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    renewer = asyncio.create_task(renew_leases())
+    logger.info(f"Queue worker {QUEUE_WORKER_ID} started ({worker_pool.workers} slots)")
+
+    while not stop.is_set():
+        rows = []
+        try:
+            await worker_pool.run_blocking(reap_dead_leases)
+            free = worker_pool.idle_workers()
+            if free and worker_pool.try_reserve(free):
+                try:
+                    rows = await worker_pool.run_blocking(claim_queue_items, QUEUE_WORKER_ID, free)
+                    for row in rows:
+                        leased[row["id"]] = row
+                        worker_pool.submit(process_item, row)
+                finally:
+                    worker_pool.release(free - len(rows))
+        except Exception as e:
+            logger.error(f"Queue poll failed: {e}")
+
+        if not rows:
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=QUEUE_POLL_SEC)
+            except asyncio.TimeoutError:
+                pass
+
+    logger.info(f"Queue worker {QUEUE_WORKER_ID} stopping, {len(leased)} invoice(s) in flight")
+    if worker_pool.tasks:
+        await asyncio.wait(set(worker_pool.tasks), timeout=QUEUE_SHUTDOWN_GRACE_SEC)
+    renewer.cancel()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())